@@ -1,21 +1,15 @@
-import matplotlib
-import matplotlib.patches as patches
 import sys
 import os
 import gc
 import math
 import Queue
 import logging
-import csv
+import threading
+import traceback
+import ecg_engine
 from time import sleep
-matplotlib.use('TkAgg')
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
-from matplotlib.figure import Figure
-from matplotlib.widgets import RectangleSelector
 
-DAT_FILE_NUM = 4
-EXIT_SUCCESS = 0
-EXIT_FAILURE = 1
+from ecg_engine import DAT_FILE_NUM, EXIT_SUCCESS, EXIT_FAILURE, VerticalLineNum, save_data_lead_names
 
 STEP_ONE = 0  # select rectangle
 STEP_TWO = 1  # draw vertical lines
@@ -24,395 +18,131 @@ STEP_FOUR = 3  # draw horizontal lines
 STEP_FIVE = 4  # draw ROI
 
 ROI_MARK_PADDING = 30
+ROI_EDGE_PIXELS = 5  # grabbing an ROI this close to its edge resizes it
 
 curr_step = STEP_ONE
 
 disablers = {}
 enablers = {}
 
-save_data_lead_names = ["I", "aVR", "V1", "V4",
-             "II", "aVL", "V2", "V5",
-             "III", "aVF", "V3", "V6"]
-
 WARNING_TITLE = "Warning"
 WARNING_WINDOW_GEOMETRY = "200x100"
 gc.enable()
 
-if sys.version_info[0] < 3:
-    import Tkinter as Tk
-else:
-    import tkinter as Tk
-
-from tkFileDialog import askdirectory, asksaveasfile
-
 
 whiteSpaceLength = 0.3
 paddingLength = 0.1
-VerticalLineNum = 5
 OpEnabled = 1
 
 userModes = ['Mark calibration box', 'Mark lead start/end', 'Mark Sync time in 4 columns',
              'Mark 3 zero reference voltages', 'Mark ROI']
 
-root = Tk.Tk()
-root.wm_title("ECG Analyzer 2.0")
-
-# get screen width and height
-ws = root.winfo_screenwidth()  # width of the screen
-hs = root.winfo_screenheight()  # height of the screen
+# the window, the plot and the Tk variables are made by createApp(), so
+# importing this file opens nothing
+root = None
+f = None
+mainAx = None
+canvas = None
+toolbar = None
+radioButtonState = None
+enableCheckBoxState = None
+selectedOp = None
+progressText = None
+redrawScheduler = None
+markerBlitter = None
+worker = None
+rectSelectorHandle = None
+roiDragger = None
 
-root.geometry('{}x{}+{}+{}'.format(int(ws*.8), int(hs*.8), int(ws*.1), int(hs*.1)))
-f = Figure(figsize=(5, 4), dpi=100)
-mainAx = f.add_subplot(111)
-
-radioButtonState = Tk.IntVar()
-radioButtonState.set(1)  # initialize
-
-enableCheckBoxState = Tk.IntVar()
-enableCheckBoxState.set(1)  # allow drawing
-selectedOp = Tk.StringVar()
-selectedOp.set(userModes[STEP_ONE])
 drawVLineHandle = None
 drawSyncLineHandle = None
 drawHorizontalLineHandle = None
 
 dataLoaded = False
 
-class ROI(object):
-    xs = None
-    ys = None
-    rect_handle = None
-
-    def __init__(self, xs, ys, rect_handle, y_offset, x_ref_pos):
-        if(len(xs) != len(ys)):
-            print 'For each ROI, the number of x points must equal to the number of y points'
-            assert False
-        self.xs = xs
-        self.ys = ys
-        self.transformed_xs, self.transformed_ys = self.transform_xy(self.xs, self.ys, y_offset, x_ref_pos)
-        # self.transformed_ys
-        self.rect_handle = rect_handle
-
-    def transform_xy(self, xs, ys, y_offset, x_ref_pos):
-      index = 0
-      rounder = lambda x: float("{0:.4g}".format(x))
-      x_scale = cali_info.Xscale
-      y_scale = cali_info.Yscale
-      x_s = []
-      y_s = []
-      for x in xs:
-          x -= x_ref_pos
-          x_s.append(rounder(x * x_scale))
-          y_s.append(rounder((ys[index] - y_offset) * y_scale))
-          index += 1
-
-      lastX = x_s[0]
-      x_s = x_s[1:]
-      uniqueXs = [lastX]
-      uniqueYs = [y_s[0]]
-      y_s = y_s[1:]
-      uniqIndex = 0
-      originalIndex = 0
-      for x in x_s:
-          if x == lastX:
-              averagedY = (y_s[originalIndex] + uniqueYs[uniqIndex]) / 2
-              averagedY = rounder(averagedY)
-              uniqueYs[uniqIndex] = averagedY
-          else:
-              uniqueXs.append(x)
-              uniqueYs.append(y_s[originalIndex])
-              uniqIndex += 1
-              lastX = x
-
-          originalIndex += 1
-
-      return uniqueXs, uniqueYs
-
-    def get_ROI_len(self):
-        return len(self.xs)
-
-    def get_xs(self):
-      return self.xs
-
-    def get_ys(self):
-      return self.ys
-
-    def get_transformed_xs(self):
-        return self.transformed_xs
-
-    def get_transformed_ys(self):
-        return self.transformed_ys
-
-    def delete(self):
-        if self.rect_handle is None:
-            return
-        self.rect_handle.remove()
-        del self.xs[:]
-        del self.ys[:]
-        # canvas.draw()
-
-# A class used to manage all input data and perform transformation on it
-class AllRows(object):
-    inputXY = None
-    invertedInputXY = None
+# A class used to manage all input data and draw it on the canvas
+class AllRows(ecg_engine.AllRows):
     plotHandles = None
-    ROIs = None
-
-    allXmax = 0
-    allXmin = 0
-
-    allYmax = 0
-    allYmin = 0
-    rowDistance = 20
-    distanceFromBottom = 10
-    isInverted = False
-    ROI_ready_to_save = False
+    plotedRows = None
+    ROICollection = None
 
     def __init__(self):
-        self.inputXY = []
-        self.invertedInputXY = []
+        ecg_engine.AllRows.__init__(self)
         self.plotHandles = []
-        self.ROIs = []  # a list of ROI objects
-
-    def is_ROI_ready(self):
-      return self.ROI_ready_to_save
 
     def deleteROIs(self):
         if self.ROIs is None:
             return
 
-        for roi in self.ROIs:
-            roi.delete()
-        canvas.draw()
-        del self.ROIs[:]
-
-    # draw a rectange on the canvas and return a list: [xs, ys, handle of the rectangle]
-    # return an empty list if it fails
-    def mark_region(self, row, x_start, x_end, x_ref_pos, y_offset):
-        ret_xs = list()
-        ret_ys = list()
-        y_min = row.ys[0]
-        y_max = y_min
-        idx = 0
-        for x in row.xs:
-            if (x_start <= x) and (x <= x_end):
-                ret_xs.append(x)
-                y = row.ys[idx]
-                ret_ys.append(y)
-                if y < y_min:
-                    y_min = y
-                if y > y_max:
-                    y_max = y
-            idx += 1
-
-        rectPatch = patches.Rectangle((x_start, y_min - ROI_MARK_PADDING), x_end - x_start, y_max - y_min + ROI_MARK_PADDING * 2, alpha=0.3) # edgecolor='red', fill=False)
-        mainAx.add_patch(rectPatch)
-        canvas.draw()
-
-        # return a ROI object
-        return ROI(ret_xs, ret_ys, rectPatch, y_offset, x_ref_pos)
-
-    def mark_ROI_regions(self, x_start_offset, ROI_len, syncLineXs):
-        x_y_data = self.getCurrentPlotedXYs()
-        # ret_ROI_len = None
-        x_y_data = x_y_data[1:]
-        x_y_data = reversed(x_y_data)
-        hLineYs = h_lines.getYs()
-        hLineYs.reverse()
-        row_index = 0
-        for row in x_y_data:
-            for syncLineX in syncLineXs:
-                x_start = syncLineX - x_start_offset
-                x_end = x_start + ROI_len
-                region_interested = self.mark_region(row, x_start, x_end, syncLineX, hLineYs[row_index])
-                # if ret_ROI_len is None:
-                #   ret_ROI_len = region_interested.get_ROI_len()
-                # else:
-                  # make sure each ROI has the same length
-                  # assert ret_ROI_len is region_interested.get_ROI_len()
-                # print 'ROI len: ', ret_ROI_len
-                self.ROIs.append(region_interested)
-            row_index += 1
-
-    def save_ROI_regions(self, fd):
-        if len(self.ROIs) is 0:
-            print 'ROIs not marked yet'
-            return
-
-        if len(self.ROIs) is not len(save_data_lead_names):
-            print 'The number of ROI is wrong: ', len(self.ROIs)
-            return
-
-        csv.register_dialect('excel_custom', 'excel', lineterminator='\n')
-        writer = csv.writer(fd, 'excel_custom')
-        titleRow = []
-        for leadName in save_data_lead_names:
-            titleRow.append(leadName + ' (X)')
-            titleRow.append(leadName + ' (Y)')
-        writer.writerow(titleRow)
-        # assume the ROI is arranged in the correct order corresponding to the title header
-        allLeads = []
-        for ROI in self.ROIs:
-            xs = ROI.get_transformed_xs()
-            ys = ROI.get_transformed_ys()
-            allLeads.append([x for x in xs])
-            allLeads.append([y for y in ys])
-        allLeads = zip(*allLeads)
-        for eachRow in allLeads:
-            writer.writerow(eachRow)
-
-        fd.close()
+        if self.ROICollection is not None:
+            self.ROICollection.remove()
+            self.ROICollection = None
+        ecg_engine.AllRows.deleteROIs(self)
+        redrawScheduler.requestDraw()
 
+    # draw the rectangles of all ROIs on the canvas as one collection, so they
+    # are added and deleted in one go
+    def mark_regions(self, regions):
+        rectPatches = []
+        for x_start, x_end, y_min, y_max in regions:
+            rectPatches.append(patches.Rectangle((x_start, y_min - ROI_MARK_PADDING), x_end - x_start, y_max - y_min + ROI_MARK_PADDING * 2, alpha=0.3)) # edgecolor='red', fill=False)
 
-    def addRow(self, xs, ys):
+        self.ROICollection = PatchCollection(rectPatches, match_original=True)
+        mainAx.add_collection(self.ROICollection)
+        redrawScheduler.requestDraw()
 
-        row = OneRowXY(xs, ys)
-        row.resetMaxMinAverage()
-        self.inputXY.append(row)
-        self.invertedInputXY.append(OneRowXY(xs, ys))
-
-    # when this function is called. It means all data are stored in inputXY
-    # This function 1. calculate the inverted version of the data and store it
-    # 2. adjust the saved data
     def finishLoading(self):
-        self.inputXY = self.adjustRows(self.inputXY)
-
-        # find the global maximum Y
-        for eachRow in self.inputXY:
-
-            if self.allXmax < eachRow.xMax:
-                self.allXmax = eachRow.xMax
-
-            if self.allXmin > eachRow.xMin:
-                self.allXmin = eachRow.xMin
-
-            if self.allYmax < eachRow.yMax:
-                self.allYmax = eachRow.yMax
-
+        ecg_engine.AllRows.finishLoading(self)
         self.plotRows(self.inputXY)
 
-        index = 0
-        for eachRow in self.inputXY:
-            self.invertedInputXY[index].ys = list(map(lambda y: (self.allYmax - y), eachRow.ys))
-            self.invertedInputXY[index].xs = eachRow.xs
-            self.invertedInputXY[index].resetMaxMinAverage()
-            index += 1
-        self.invertedInputXY = self.adjustRows(self.invertedInputXY)
-        # at this point, both invertedInputXY and XY are sorted
-
+    # only a min/max decimated copy of each row is plotted, see refreshLOD
     def plotRows(self, rows):
-        for eachRow in rows:
-            pltHandle, = mainAx.plot(eachRow.xs, eachRow.ys, color='black')
-            self.plotHandles.append(pltHandle)
+        self.plotedRows = rows
+        with ecg_engine.profiler.stage('plotRows') as stage:
+            for eachRow in rows:
+                index = eachRow.getLODRange(eachRow.xMin, eachRow.xMax, self.getPlotWidth())
+                pltHandle, = mainAx.plot(eachRow.xs[index], eachRow.ysAt(index), color='black')
+                self.plotHandles.append(pltHandle)
+                stage.samples += len(pltHandle.get_xdata())
+        # zoomed in before (e.g. inverting): match the view that is kept
+        if not mainAx.get_autoscalex_on():
+            self.refreshLOD(mainAx)
 
         mainAx.set_ylim([0, self.allYmax + 20])
-        canvas.draw()
+        redrawScheduler.requestDraw()
 
-    def invert(self):
-        # remove the current plot
-        for eachHandle in self.plotHandles:
-            eachHandle.remove()
-        canvas.draw()
-        self.plotHandles = []
-
-        self.isInverted = not self.isInverted
-        if self.isInverted:
-            self.plotRows(self.invertedInputXY)
-        else:
-            self.plotRows(self.inputXY)
-
-    def getCurrentPlotedXYs(self):
-        if self.isInverted:
-            return self.invertedInputXY
-        else:
-            return self.inputXY
-
-    # adjust the position of these XY rows
-    def adjustRows(self, rows):
-        rows = sorted(rows)
-        # shift the lowest line
-        shiftUpOffset = self.distanceFromBottom - rows[0].yMin
-        rows[0].ys = list(map(lambda y: (y + shiftUpOffset), rows[0].ys))
-        rows[0].resetMaxMinAverage()
-        prevYmax = 0
-        index = 0
+    # number of pixel columns the main axis covers
+    def getPlotWidth(self):
+        return int(mainAx.bbox.width)
 
-        for eachRow in rows:
-            shiftUpOffset = (prevYmax + self.rowDistance) - eachRow.yMin
-            eachRow.ys = list(map(lambda y: (y + shiftUpOffset), eachRow.ys))
-            eachRow.resetMaxMinAverage()  # reset the max Y for each row
-            prevYmax = eachRow.yMax
-            rows[index] = eachRow
-            index += 1
-
-        return rows
+    # called whenever the x-limits change (zoom, pan, home...): refine or
+    # coarsen the plotted rows to match the new view. The caller draws
+    def refreshLOD(self, ax):
+        if self.plotedRows is None or len(self.plotHandles) != len(self.plotedRows):
+            return
+        x_start, x_end = sorted(ax.get_xlim())
+        width = self.getPlotWidth()
+        for eachRow, eachHandle in zip(self.plotedRows, self.plotHandles):
+            index = eachRow.getLODRange(x_start, x_end, width)
+            eachHandle.set_data(eachRow.xs[index], eachRow.ysAt(index))
+
+    # both views have the same number of rows over the same xs, so the lines
+    # already on the axis just get the data of the other view
+    def invert(self):
+        ecg_engine.AllRows.invert(self)
+        self.plotedRows = self.getCurrentPlotedXYs()
+        self.refreshLOD(mainAx)
+        redrawScheduler.requestDraw()
 
     def reset(self):
         self.deleteROIs()
         for eachHandle in self.plotHandles:
             eachHandle.remove()
-        canvas.draw()
-
-        del self.inputXY[:]
-        del self.invertedInputXY[:]
+        redrawScheduler.requestDraw()
         del self.plotHandles[:]
+        self.plotedRows = None
 
-        self.allYmax = 0
-        self.allYmin = 0
-        self.allXmax = 0
-        self.allXmin = 0
-        self.rowDistance = 20
-        self.distanceFromBottom = 10
-        self.isInverted = False
-
-
-class OneRowXY(object):
-    xs = []
-    ys = []
-    yMin = 0
-    yMax = 0
-    yAve = 0
-
-    xMin = 0
-    xMax = 0
-
-    def __init__(self, xs=None, ys=None):
-        if ys is None:
-            ys = []
-        if xs is None:
-            xs = []
-
-        if len(xs) != len(ys):
-            print 'This is weird. A row should have equal number of Xs and Ys'
-            assert False
-
-        self.xs = xs
-        self.ys = ys
-        self.yMin = min(ys)
-        self.yMax = max(ys)
-        self.xMin = min(xs)
-        self.xMax = max(xs)
-        self.yAve = reduce(lambda x, y: x + y, ys) / len(ys)
-
-    def resetMaxMinAverage(self):
-        self.yAve = reduce(lambda x, y: x + y, self.ys) / len(self.ys)
-        self.yMin = min(self.ys)
-        self.yMax = max(self.ys)
-        self.xMin = min(self.xs)
-        self.xMax = max(self.xs)
-
-    # implement the comparing interface
-    def __lt__(self, other):
-        return self.yAve < other.yAve
-
-    def __gt__(self, other):
-        return self.yAve > other.yAve
-
-    def __eq__(self, other):
-        return self.yAve == other.yAve
-
-    def __ne__(self, other):
-        return not self.__eq__(other)
+        ecg_engine.AllRows.reset(self)
 
 
 # for each vertical line
@@ -453,13 +183,12 @@ class VLines(object):
             return False
 
         vline = self.currVLineXs.get()
-        vline.handle.remove()
+        markerBlitter.remove(vline.handle)
         return True
 
     def deleteAll(self):
         while self.deleteVerticalLine() is True:
             continue
-        canvas.draw()
 
     def getXs(self):
         Xs = []
@@ -497,8 +226,7 @@ class VSyncLines(object):
             return False
 
         vline = self.currSyncLineXs.get()
-        vline.handle.remove()
-        canvas.draw()
+        markerBlitter.remove(vline.handle)
         return True
 
     def deleteAll(self):
@@ -543,8 +271,7 @@ class HLines(object):
             return False
 
         hline = self.currYs.get()
-        hline.handle.remove()
-        canvas.draw()
+        markerBlitter.remove(hline.handle)
         return True
 
     def deleteAll(self):
@@ -570,62 +297,211 @@ class HLines(object):
         return self.maxHlineNum == self.currYs.qsize()
 
 
-class CaliInfo(object):
-    caliFactor1 = None
-    caliFactor2 = None
-
-    deltaX = None
-    deltaY = None
-
-    handle = None
-    Yscale = None
-    Xscale = None
+class CaliInfo(ecg_engine.CaliInfo):
 
-    def __init__(self):
+    def deleteRect(self):
+        if self.handle is None:
+            return
+        markerBlitter.remove(self.handle)
+        self.handle = None
         self.resetAll()
 
-    def setXY(self, info):
-        self.deltaX = info[0]
-        self.deltaY = info[1]
-
-    def setCaliFactor(self, factors):
-        self.voltageCalibrationFactor = factors[0]
-        self.timeCalibrationFactor = factors[1]
 
-        self.Yscale = float(self.voltageCalibrationFactor) / self.deltaY
-        self.Xscale = float(self.timeCalibrationFactor) / self.deltaX
-
-    def getCaliInfor(self):
-        if self.handle is None:
-            return None
-
-        return [self.caliFactor1, self.caliFactor2, self.leftTopX, self.leftTopY, self.rightBottomX, self.rightBottomY]
+# Every change to the plot asks for a redraw here instead of calling
+# canvas.draw() itself. The canvas is rendered once, the next time Tk is idle,
+# however many changes were made in between (e.g. restarting deletes all ROIs
+# and lines, marking ROIs adds 12 rectangles)
+class RedrawScheduler(object):
+    pendingId = None
+
+    def __init__(self, canvas, root):
+        self.canvas = canvas
+        self.root = root
+        self.pendingId = None
+        self.needDraw = False
+        self.blitFunc = None
+        # requests vs. what was actually rendered
+        self.drawRequests = 0
+        self.blitRequests = 0
+        self.draws = 0
+        self.blits = 0
+
+    # the whole figure has to be rendered again
+    def requestDraw(self):
+        self.drawRequests += 1
+        self.needDraw = True
+        self.schedule()
+
+    # only the animated markers changed. A pending full draw covers them too
+    def requestBlit(self, blit_func):
+        self.blitRequests += 1
+        self.blitFunc = blit_func
+        self.schedule()
+
+    def schedule(self):
+        if self.pendingId is None:
+            self.pendingId = self.root.after_idle(self.flush)
+
+    def flush(self):
+        self.pendingId = None
+        blitFunc = self.blitFunc
+        self.blitFunc = None
+        if self.needDraw:
+            self.needDraw = False
+            self.draws += 1
+            with ecg_engine.profiler.stage('draw'):
+                self.canvas.draw()
+        elif blitFunc is not None:
+            self.blits += 1
+            blitFunc()
+
+    def getStats(self):
+        return {'drawRequests': self.drawRequests, 'draws': self.draws,
+                'coalescedDraws': self.drawRequests - self.draws,
+                'blitRequests': self.blitRequests, 'blits': self.blits,
+                'coalescedBlits': self.blitRequests - self.blits}
+
+
+# Markers (calibration box, vertical, sync and horizontal lines) are animated
+# artists. They are drawn on top of a saved copy of the plot, so adding or
+# deleting one only repaints the markers and not the full-resolution traces
+class MarkerBlitter(object):
+    background = None
+    artists = None
+
+    def __init__(self, canvas, ax, scheduler):
+        self.canvas = canvas
+        self.ax = ax
+        self.scheduler = scheduler
+        self.artists = []
+        self.background = None
+        canvas.mpl_connect('draw_event', self.onDraw)
+
+    # a full draw happened (loading, zooming, panning, resizing...): save the
+    # new background and put the markers back on it
+    def onDraw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.drawMarkers()
+
+    def add(self, artist):
+        artist.set_animated(True)
+        self.artists.append(artist)
+        self.update()
+
+    def remove(self, artist):
+        if artist in self.artists:
+            self.artists.remove(artist)
+        artist.remove()
+        self.update()
+
+    def drawMarkers(self):
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def update(self):
+        if self.background is None:
+            self.scheduler.requestDraw()
+            return
+        self.scheduler.requestBlit(self.blit)
 
-    def setHandle(self, handle):
-        self.handle = handle
+    def blit(self):
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.drawMarkers()
+        self.canvas.blit(self.ax.bbox)
+
+
+# Runs one long operation (loading, saving, exporting) at a time on a worker
+# thread, so the window keeps responding. Tk and matplotlib are only touched
+# from the Tk thread: the result is picked up by polling with root.after and
+# handed to on_done there
+class BackgroundWorker(object):
+    POLL_MS = 100
+
+    def __init__(self, root, progress_text):
+        self.root = root
+        self.progressText = progress_text
+        self.results = Queue.Queue()
+        self.cancelEvent = threading.Event()
+        self.thread = None
+        self.name = None
+        self.onDone = None
+        self.onFail = None
+        self.done = 0
+        self.total = 0
+
+    def busy(self):
+        return self.thread is not None
+
+    # work(progress) runs on the worker thread and must not touch Tk or the
+    # canvas. on_done(result) is called on the Tk thread when it succeeds,
+    # on_fail() when it is cancelled or fails
+    def run(self, name, work, on_done=None, on_fail=None):
+        if self.busy():
+            print 'Another operation is still running:', self.name
+            assert False
 
-    def caliInfoReady(self):
-        return self.handle is not None
-        # return (self.caliFactor1 is not None) and (self.caliFactor2 is not None) and \
-        #        (self.leftTopX is not None) and (self.leftTopY is not None) and \
-        #        (self.rightBottomX is not None) and (self.rightBottomY is not None) and \
-        #        (self.handle is not None)
+        self.name = name
+        self.onDone = on_done
+        self.onFail = on_fail
+        self.done = 0
+        self.total = 0
+        self.cancelEvent.clear()
+        self.progressText.set(name + '...')
+
+        self.thread = threading.Thread(target=self.work, args=(work,))
+        self.thread.daemon = True
+        self.thread.start()
+        self.root.after(self.POLL_MS, self.poll)
+
+    def cancel(self):
+        if self.busy():
+            self.cancelEvent.set()
+            self.progressText.set(self.name + ': cancelling...')
+
+    # the progress callback given to work, called on the worker thread
+    def reportProgress(self, done, total):
+        if self.cancelEvent.is_set():
+            raise ecg_engine.OperationCancelled()
+        self.done = done
+        self.total = total
+
+    def work(self, work):
+        try:
+            self.results.put(('done', work(self.reportProgress)))
+        except ecg_engine.OperationCancelled:
+            self.results.put(('cancelled', None))
+        except Exception as e:
+            traceback.print_exc()
+            self.results.put(('failed', '{0}: {1}'.format(type(e).__name__, e)))
+
+    def poll(self):
+        try:
+            status, result = self.results.get_nowait()
+        except Queue.Empty:
+            if self.total != 0 and not self.cancelEvent.is_set():
+                self.progressText.set('{0}... {1}%'.format(self.name, 100 * self.done // self.total))
+            self.root.after(self.POLL_MS, self.poll)
+            return
 
-    def deleteRect(self):
-        if self.handle is None:
+        self.thread.join()
+        self.thread = None
+        writeProfile()
+        if status == 'done':
+            self.progressText.set('')
+            if self.onDone is not None:
+                self.onDone(result)
             return
-        self.handle.remove()
-        canvas.draw()
-        self.handle = None
-        self.resetAll()
 
-    def resetAll(self):
-        self.leftTopX = None
-        self.leftTopY = None
-        self.rightBottomX = None
-        self.rightBottomY = None
-        self.caliFactor1 = None
-        self.caliFactor2 = None
+        if self.onFail is not None:
+            self.onFail()
+        if status == 'cancelled':
+            self.progressText.set(self.name + ' cancelled')
+        else:
+            self.progressText.set(self.name + ' failed')
+            remindWindow('Error!', self.name + ' failed: ' + result)
 
 
 # global vars keeping track of current data and objects drew on the canvas
@@ -635,25 +511,69 @@ sync_lines = VSyncLines()
 h_lines = HLines()
 cali_info = CaliInfo()
 
-# a tk.DrawingArea
-canvas = FigureCanvasTkAgg(f, master=root)
-canvas.show()
-canvas.get_tk_widget().pack(side=Tk.BOTTOM, fill=Tk.BOTH, expand=10)
 
-toolbar = NavigationToolbar2TkAgg(canvas, root)
-toolbar.update()
-canvas._tkcanvas.pack(side=Tk.TOP, fill=Tk.BOTH, expand=10)
+# Tk and matplotlib are only imported here, the first time the window is
+# needed. Returns the Tk root
+def createApp():
+    global Tk, matplotlib, patches, PatchCollection, RectangleSelector, askdirectory, asksaveasfile, asksaveasfilename
+    global root, f, mainAx, canvas, toolbar, radioButtonState, enableCheckBoxState, selectedOp, progressText
+    global redrawScheduler, markerBlitter, worker, rectSelectorHandle, roiDragger
+    if root is not None:
+        return root
 
+    if sys.version_info[0] < 3:
+        import Tkinter as Tk
+    else:
+        import tkinter as Tk
+    from tkFileDialog import askdirectory, asksaveasfile, asksaveasfilename
+
+    import matplotlib
+    matplotlib.use('TkAgg')
+    import matplotlib.patches as patches
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
+    from matplotlib.figure import Figure
+    from matplotlib.widgets import RectangleSelector
+    from matplotlib.collections import PatchCollection
+
+    root = Tk.Tk()
+    root.wm_title("ECG Analyzer 2.0")
+
+    # get screen width and height
+    ws = root.winfo_screenwidth()  # width of the screen
+    hs = root.winfo_screenheight()  # height of the screen
+
+    root.geometry('{}x{}+{}+{}'.format(int(ws*.8), int(hs*.8), int(ws*.1), int(hs*.1)))
+    f = Figure(figsize=(5, 4), dpi=100)
+    mainAx = f.add_subplot(111)
+
+    radioButtonState = Tk.IntVar()
+    radioButtonState.set(1)  # initialize
+
+    enableCheckBoxState = Tk.IntVar()
+    enableCheckBoxState.set(1)  # allow drawing
+    selectedOp = Tk.StringVar()
+    selectedOp.set(userModes[STEP_ONE])
+    progressText = Tk.StringVar()
+    progressText.set('')
+
+    # a tk.DrawingArea
+    canvas = FigureCanvasTkAgg(f, master=root)
+    canvas.show()
+    canvas.get_tk_widget().pack(side=Tk.BOTTOM, fill=Tk.BOTH, expand=10)
+
+    redrawScheduler = RedrawScheduler(canvas, root)
+    markerBlitter = MarkerBlitter(canvas, mainAx, redrawScheduler)
+    worker = BackgroundWorker(root, progressText)
+    mainAx.callbacks.connect('xlim_changed', XYs.refreshLOD)
+
+    toolbar = NavigationToolbar2TkAgg(canvas, root)
+    toolbar.update()
+    canvas._tkcanvas.pack(side=Tk.TOP, fill=Tk.BOTH, expand=10)
 
-def readXYfromFile(file_name):
-    xs = []
-    ys = []
-    with open(file_name) as fp:
-        for line in fp:
-            xyStr = line.split()
-            xs.append(float(xyStr[0]))
-            ys.append(float(xyStr[1]))
-    return xs, ys
+    # the right button is left for dragging the marked ROI, see ROIDragger
+    rectSelectorHandle = RectangleSelector(mainAx, drawRectCallBack, drawtype='box', button=[1])
+    roiDragger = ROIDragger()
+    return root
 
 
 def remindLoadingData():
@@ -671,47 +591,95 @@ def remindWindow(title, content):
     button.pack()
     return
 
-# rowDistance: distance between the Y max and Y min of two adjacent rows
-def plotRawDataFromDir(dir_name, rowDistance=20):
+# with ECG_PROFILE set, the stages recorded so far are written to
+# ecg_profile.json in the study folder after every long operation
+def writeProfile():
+    if not ecg_engine.profiler.enabled or len(XYs.sourceFiles) == 0:
+        return
+    profileFile = os.path.join(os.path.dirname(XYs.sourceFiles[0]), ecg_engine.PROFILE_FILE_NAME)
+    try:
+        ecg_engine.profiler.writeReport(profileFile, {'study': os.path.dirname(XYs.sourceFiles[0]),
+                                                      'redraws': redrawScheduler.getStats()})
+    except IOError as e:
+        print 'Cannot write the profile:', e
+
+
+# long operations run one at a time, and nothing may change the data under them
+def isBusy():
+    if worker.busy():
+        remindWindow('Wait...', worker.name + ' is still running')
+        return True
+    return False
+
+
+# a save that did not finish leaves no half written file behind
+def discardFile(file_name):
+    if os.path.exists(file_name):
+        os.remove(file_name)
+
+
+# returns the .dat files of dir_name, or None if it is not a study
+def getStudyFiles(dir_name):
     allInputFiles = []
     try:
-        allInputFiles = os.listdir(dir_name)
+        allInputFiles = ecg_engine.getDatFiles(dir_name)
     except OSError:
         remindWindow('Error!', 'No such a directory')
-        return EXIT_FAILURE
-
-    global XYs, yMax, yMin
-
-    allInputFiles = list(filter(lambda fn: ('.dat' in fn), allInputFiles))
+        return None
 
     if len(allInputFiles) != DAT_FILE_NUM:
         remindWindow('Error!', 'Need exactly ' + str(DAT_FILE_NUM) + ' dat files')
-        return EXIT_FAILURE
+        return None
 
-    allInputFiles = list(map(lambda fn: (dir_name + '/' + fn), allInputFiles))
     logging.debug(allInputFiles)
+    return allInputFiles
 
-    for idx, inputFile in enumerate(allInputFiles):
-        # print inputFile
-        xs, ys = readXYfromFile(inputFile)
+
+# allXYs: [xs, ys] of each file of allInputFiles
+def showRawData(allXYs, allInputFiles):
+    global XYs, yMax, yMin
+
+    for xs, ys in allXYs:
         XYs.addRow(xs, ys)
+    XYs.sourceFiles = allInputFiles
 
     XYs.finishLoading()
+
+
+# rowDistance: distance between the Y max and Y min of two adjacent rows
+def plotRawDataFromDir(dir_name, rowDistance=20):
+    allInputFiles = getStudyFiles(dir_name)
+    if allInputFiles is None:
+        return EXIT_FAILURE
+
+    showRawData(ecg_engine.readAllDatFiles(allInputFiles), allInputFiles)
     return EXIT_SUCCESS
 
 # button callbacks
 def browseCallBack():
+    if isBusy():
+        return
     dir = askdirectory()
     print dir
-    ret = plotRawDataFromDir(dir)
-    if ret == EXIT_SUCCESS:
+    allInputFiles = getStudyFiles(dir)
+    if allInputFiles is None:
+        return
+
+    # the files are read on the worker thread, the rows are plotted back on the Tk thread
+    def loaded(allXYs):
+        showRawData(allXYs, allInputFiles)
         global dataLoaded
         dataLoaded = True
+        restoreSessionFile()
+
+    worker.run('Loading', lambda progress: ecg_engine.readAllDatFiles(allInputFiles, progress), loaded)
 
 def invertCallBack():
     if not dataLoaded:
         remindLoadingData()
         return
+    if isBusy():
+        return
     print 'invert button clicked'
     global XYs
     XYs.invert()
@@ -759,6 +727,9 @@ def promptCaliFactor():
 #                                                          |___/
 
 def drawCaliRectCallBack(eclick, erelease):
+    if isBusy():
+        return
+
     if enableCheckBoxState.get() is not OpEnabled:
         remindWindow('Wait...', 'Check \'Enable Marker Placement\' to enable this feature')
         return
@@ -779,13 +750,16 @@ def drawCaliRectCallBack(eclick, erelease):
         remindWindow('Error!', 'Invalid rectange. y distance too small')
         return
 
-    rectPatch = patches.Rectangle((eclick.xdata, eclick.ydata), deltaX, deltaY, edgecolor='red', fill=False)
+    addCaliRect(eclick.xdata, eclick.ydata, deltaX, deltaY)
+    promptCaliFactor()
+
+def addCaliRect(x, y, deltaX, deltaY):
+    rectPatch = patches.Rectangle((x, y), deltaX, deltaY, edgecolor='red', fill=False)
     mainAx.add_patch(rectPatch)
 
     cali_info.setXY([deltaX, deltaY])
     cali_info.setHandle(rectPatch)
-    canvas.draw()
-    promptCaliFactor()
+    markerBlitter.add(rectPatch)
 
 # draw Rectangle switches
 def drawRectCallBack(eclick, erelease):
@@ -809,8 +783,6 @@ def drawRectCallBack(eclick, erelease):
         print 'Draw rectangle is only valid for drawing calibration rectange or makr ROI. There must be some code logic issues'
         assert False
 
-rectSelectorHandle = RectangleSelector(mainAx, drawRectCallBack, drawtype='box')
-
 def enableRectSelector():
     global rectSelectorHandle
     if not rectSelectorHandle.active:
@@ -869,6 +841,9 @@ def ROICallBack(eclick, erelease):
         remindLoadingData()
         return
 
+    if isBusy():
+        return
+
     if enableCheckBoxState.get() is not OpEnabled:
         remindWindow('Wait...', 'Check \'Enable Marker Placement\' to enable this feature')
         return
@@ -903,54 +878,157 @@ def validate_and_mark_ROI_regions(x_min, x_max):
 
     vLineXs = ret[0]
     syncLineXs = ret[1]
+    hLineYs = ret[2]
 
     # validate marked region
-    # find regions that ROI is allowed to be in
-    regions = list()
-    for i in range(len(syncLineXs)):
-        region = list()
-        region.append(vLineXs[i])  # blue vertical line
-        region.append(syncLineXs[i])  # green vertical (sync) line
-        region.append(vLineXs[i+1])
-        regions.append(region)
-
-    # print x_min
-    # print x_max
-    # check which region is the marked ROI in
-    region_start = None
-    sync_line_x_pos = None
-    for region in regions:
-        # print region
-        # found it to the left of the vertical sync line
-        if (region[0] <= x_min) and (x_max <= region[1]):
-            # region_start = region[0]
-            sync_line_x_pos = region[1]
-            break
-
-        # found it to the right of the vertical sync line
-        if (region[1] <= x_min) and (x_max <= region[2]):
-            # region_start = region[1]
-            sync_line_x_pos = region[1]
-            break
-
-    # if (region_start == None) or (region_end == None):
-    if sync_line_x_pos is None:
+    window = ecg_engine.findROIWindow(vLineXs, syncLineXs, x_min, x_max)
+    if window is None:
         remindWindow('Wait...', 'Invalid ROI')
         return False
 
-    # transform [x_min, x_max] to [x_start_offset, ROI_len]
-    ROI_len = x_max - x_min
-    x_start_offset = sync_line_x_pos - x_min  # how much to the left of the sync line it is
+    x_start_offset = window[0]
+    ROI_len = window[1]
 
     # mark ROI on the plot
-    XYs.mark_ROI_regions(x_start_offset, ROI_len, syncLineXs)
+    XYs.mark_ROI_regions(x_start_offset, ROI_len, syncLineXs, hLineYs, cali_info)
     return True
 
+# Drag a marked ROI with the right mouse button to move it, or grab one of its
+# edges to resize it. All the windows follow live as blitted previews, and the
+# ROIs are only extracted again when the button is released
+class ROIDragger(object):
+
+    def __init__(self):
+        self.connections = []
+        self.tracker = None
+        self.previews = []
+
+    def enable(self):
+        if len(self.connections) != 0:
+            return
+        self.connections = [canvas.mpl_connect('button_press_event', self.onPress),
+                            canvas.mpl_connect('motion_notify_event', self.onMotion),
+                            canvas.mpl_connect('button_release_event', self.onRelease)]
+
+    def disable(self):
+        for connection in self.connections:
+            canvas.mpl_disconnect(connection)
+        self.connections = []
+        # leaving the ROI step half way through a drag keeps the ROI as it was
+        if self.dragging():
+            self.stop()
+            self.mark(self.startWindow)
+
+    def dragging(self):
+        return self.tracker is not None
+
+    def onPress(self, event):
+        if event.button != 3 or event.inaxes is not mainAx or event.xdata is None:
+            return
+        if not dataLoaded or XYs.ROIWindow is None or worker.busy():
+            return
+        if enableCheckBoxState.get() is not OpEnabled:
+            return
+
+        ret = is_data_complete_and_valid()
+        if len(ret) != 3:
+            return
+        self.vLineXs, self.syncLineXs, self.hLineYs = ret
+
+        # which window was grabbed, and where
+        x_start_offset, ROI_len = XYs.ROIWindow
+        self.mode = None
+        for syncLineX in self.syncLineXs:
+            x_start = syncLineX - x_start_offset
+            x_end = x_start + ROI_len
+            startPixel = mainAx.transData.transform((x_start, 0))[0]
+            endPixel = mainAx.transData.transform((x_end, 0))[0]
+            if abs(event.x - startPixel) <= ROI_EDGE_PIXELS:
+                self.mode = 'start'
+            elif abs(event.x - endPixel) <= ROI_EDGE_PIXELS:
+                self.mode = 'end'
+            elif x_start <= event.xdata <= x_end:
+                self.mode = 'move'
+            if self.mode is not None:
+                self.grabbedSyncLineX = syncLineX
+                break
+        if self.mode is None:
+            return
+
+        self.pressX = event.xdata
+        self.startWindow = [x_start_offset, ROI_len]
+        self.window = [x_start_offset, ROI_len]
+        self.tracker = ecg_engine.ROIWindowTracker(XYs, self.syncLineXs)
+
+        # the marked ROIs are replaced by previews until the button is released
+        XYs.deleteROIs()
+        XYs.ROI_ready_to_save = False
+        for i in range(len(self.tracker.extents)):
+            preview = patches.Rectangle((0, 0), 0, 0, alpha=0.3)
+            # add_artist leaves the data limits alone
+            mainAx.add_artist(preview)
+            self.previews.append(preview)
+            markerBlitter.add(preview)
+        self.showPreviews()
+
+    def onMotion(self, event):
+        if not self.dragging() or event.xdata is None:
+            return
+
+        dx = event.xdata - self.pressX
+        x_start_offset, ROI_len = self.startWindow
+        if self.mode == 'move':
+            x_start_offset -= dx
+        elif self.mode == 'start':
+            x_start_offset -= dx
+            ROI_len -= dx
+        else:
+            ROI_len += dx
+        if ROI_len <= 0:
+            return
+
+        self.window = [x_start_offset, ROI_len]
+        self.showPreviews()
+
+    def showPreviews(self):
+        regions = self.tracker.moveTo(self.window[0], self.window[1])
+        for preview, region in zip(self.previews, regions):
+            x_start, x_end, y_min, y_max = region
+            preview.set_bounds(x_start, y_min - ROI_MARK_PADDING, x_end - x_start, y_max - y_min + ROI_MARK_PADDING * 2)
+        markerBlitter.update()
+
+    def stop(self):
+        for preview in self.previews:
+            markerBlitter.remove(preview)
+        self.previews = []
+        self.tracker = None
+
+    def onRelease(self, event):
+        if not self.dragging():
+            return
+        self.stop()
+
+        # the window has to stay within the lines around the grabbed sync line
+        x_min = self.grabbedSyncLineX - self.window[0]
+        x_max = x_min + self.window[1]
+        window = ecg_engine.findROIWindow(self.vLineXs, self.syncLineXs, x_min, x_max)
+        if window is None:
+            remindWindow('Wait...', 'Invalid ROI')
+            window = self.startWindow
+        self.mark(window)
+
+    def mark(self, window):
+        XYs.mark_ROI_regions(window[0], window[1], self.syncLineXs, self.hLineYs, cali_info)
+        XYs.ROI_ready_to_save = True
+
+
 def enableDrawROI():
     enableRectSelector()
+    roiDragger.enable()
 
 def disableDrawROI():
     disableRectSelector()
+    roiDragger.disable()
 
 def enableStep(stepOn):
     # print 'stepOn: ' + str(stepOn)
@@ -995,12 +1073,16 @@ def drawVerticalLineCallback(event):
     # print('button=%d, x=%d, y=%d, xdata=%f, ydata=%f' % (
     #   event.button, event.x, event.y, event.xdata, event.ydata))
 
+    addVerticalLine(event.xdata)
+
+def addVerticalLine(x):
     # set the current axis to the main axis
     yDataMax = XYs.allYmax - whiteSpaceLength + paddingLength
     yDataMin = XYs.allYmin + whiteSpaceLength - paddingLength
-    lineHandle, = mainAx.plot([event.xdata, event.xdata], [yDataMax, yDataMin], linestyle='dashed', color='blue')
-    v_lines.addVerticalLine(VLine(lineHandle, event.xdata))
-    canvas.draw()
+    lineHandle, = mainAx.plot([x, x], [yDataMax, yDataMin], linestyle='dashed', color='blue',
+                              scalex=False, scaley=False)
+    v_lines.addVerticalLine(VLine(lineHandle, x))
+    markerBlitter.add(lineHandle)
 
 
 def drawSyncLineCallback(event):
@@ -1026,12 +1108,16 @@ def drawSyncLineCallback(event):
     # print('button=%d, x=%d, y=%d, xdata=%f, ydata=%f' % (
     #   event.button, event.x, event.y, event.xdata, event.ydata))
 
+    addSyncLine(event.xdata)
+
+def addSyncLine(x):
     # set the current axis to the main axis
     yDataMax = XYs.allYmax - whiteSpaceLength + paddingLength
     yDataMin = XYs.allYmin + whiteSpaceLength - paddingLength
-    lineHandle, = mainAx.plot([event.xdata, event.xdata], [yDataMax, yDataMin], linestyle='dashed', color='green')
-    sync_lines.addSyncLine(VLine(lineHandle, event.xdata))
-    canvas.draw()
+    lineHandle, = mainAx.plot([x, x], [yDataMax, yDataMin], linestyle='dashed', color='green',
+                              scalex=False, scaley=False)
+    sync_lines.addSyncLine(VLine(lineHandle, x))
+    markerBlitter.add(lineHandle)
 
 
 def drawHorizontalLineCallback(event):
@@ -1051,13 +1137,16 @@ def drawHorizontalLineCallback(event):
         selectOpCallBack(None)
         return
 
+    addHorizontalLine(event.ydata)
+
+def addHorizontalLine(y):
     # set the current axis to the main axis
     xDataMax = XYs.allXmax - whiteSpaceLength
     xDataMin = XYs.allXmin + whiteSpaceLength
-    lineHandle, = mainAx.plot([xDataMin, xDataMax], [event.ydata, event.ydata], linestyle='dashed', color='orange')
-    h_lines.addHLine(Hline(lineHandle, event.ydata))
-
-    canvas.draw()
+    lineHandle, = mainAx.plot([xDataMin, xDataMax], [y, y], linestyle='dashed', color='orange',
+                              scalex=False, scaley=False)
+    h_lines.addHLine(Hline(lineHandle, y))
+    markerBlitter.add(lineHandle)
 
 
 def enableCallBack():
@@ -1095,6 +1184,9 @@ def deleteCallBack():
         remindLoadingData()
         return
 
+    if isBusy():
+        return
+
     currOp = selectedOp.get()
     if currOp == userModes[STEP_ONE]:  # calibration
         cali_info.deleteRect()
@@ -1157,42 +1249,8 @@ def generateWarningMsg(warning_step):
 #  |___/\__,_| \_/ \___|  \__,_|\__,_|\__\__,_|
 #
 #
-def preSaveDataProcess(fd, vLineXs, syncLineXs, hLineYs):
-    csv.register_dialect('excel_custom', 'excel', lineterminator='\n')
-    writer = csv.writer(fd, 'excel_custom')
-
-    allXyRows = XYs.getCurrentPlotedXYs()
-    # only needs the first 3 rows (the last row is reference)
-    # assume rows are sorted already
-
-    allXyRows = allXyRows[1:]
-    allXyRows = reversed(allXyRows)
-
-    titleRow = []
-    for leadName in save_data_lead_names:
-        titleRow.append(leadName + ' (X)')
-        titleRow.append(leadName + ' (Y)')
-    writer.writerow(titleRow)
-
-    allLeads = []
-    hLineYs.reverse()
-    allXyRowsIndex = 0
-    for eachRow in allXyRows:
-        yOffset = hLineYs[allXyRowsIndex]
-        allXyRowsIndex += 1
-        leads = splitOneRow(eachRow, vLineXs, syncLineXs, yOffset)
-        # all leads should have the same number of Xs and Ys
-        for lead in leads:
-            # format to same type
-            allLeads.append([float(x) if x is not None else "" for x in lead.xs])
-            allLeads.append([float(y) if y is not None else "" for y in lead.ys])
-
-    allLeads = zip(*allLeads)
-
-    for eachRow in allLeads:
-        writer.writerow(eachRow)
-
-    fd.close()
+def preSaveDataProcess(fd, vLineXs, syncLineXs, hLineYs, progress=None):
+    ecg_engine.preSaveDataProcess(fd, vLineXs, syncLineXs, hLineYs, XYs, cali_info, progress)
 
 
 def generateTitle(row_num, col_num, lead_names):
@@ -1200,94 +1258,6 @@ def generateTitle(row_num, col_num, lead_names):
     return leadName + ' (X)', leadName + ' (Y)'
 
 
-'''
-Split a row of Xs and Ys according to the Xs of the vertical lines
-'''
-
-
-def splitOneRow(row, vLineXs, syncLineXs, yOffset):
-
-    # Truncate data before first vLine
-    truncateIndex = 0
-    while row.xs[truncateIndex] < vLineXs[0]:
-        truncateIndex += 1
-    row.xs = row.xs[truncateIndex:]
-    row.ys = row.ys[truncateIndex:]
-    row.resetMaxMinAverage()
-    vLineXs = vLineXs[1:]  # get rid of first vLine to not disturb rest of function
-
-    # back to regularly scheduled programming
-    xMin = min(row.xs)
-    leads = []  # A list of OneRowXY objects
-    xs = []
-    ys = []
-    maxLeadLen = 0
-
-    xScale = cali_info.Xscale
-    yScale = cali_info.Yscale
-
-    vLineXsIndex = 0
-    for vLineX in vLineXs:
-        index = 0
-        xOffset = syncLineXs[vLineXsIndex]
-        vLineXsIndex += 1
-
-        rounder = lambda x: float("{0:.4g}".format(x))  # round up to 4 significant figures
-        verticalLineWidthPercent = 0.02
-        deltaX = max(row.xs) - min(row.xs)
-        verticalLineWidth = verticalLineWidthPercent * deltaX
-
-        vLineX -= verticalLineWidth
-        for x in row.xs:
-            if xMin <= x < vLineX:
-                x -= xOffset
-                xs.append(rounder(x * xScale))
-                ys.append(rounder((row.ys[index] - yOffset) * yScale))
-            index += 1
-
-        lastX = xs[0]
-        xs = xs[1:]
-        uniqueXs = [lastX]
-        uniqueYs = [ys[0]]
-        ys = ys[1:]
-        uniqIndex = 0
-        originalIndex = 0
-        for x in xs:
-            if x == lastX:
-                averagedY = (ys[originalIndex] + uniqueYs[uniqIndex]) / 2
-                averagedY = rounder(averagedY)
-                uniqueYs[uniqIndex] = averagedY
-            else:
-                uniqueXs.append(x)
-                uniqueYs.append(ys[originalIndex])
-                uniqIndex += 1
-                lastX = x
-
-            originalIndex += 1
-
-        xs = uniqueXs
-        ys = uniqueYs
-
-        currLeadLen = len(xs)
-        if currLeadLen > maxLeadLen:
-            maxLeadLen = currLeadLen
-
-        leads.append(OneRowXY(xs, ys))
-        xs = []
-        ys = []
-        xMin = vLineX + verticalLineWidth * 2
-
-    # padding
-    for index in range(0, len(leads)):
-        currLen = len(leads[index].xs)
-        while currLen < maxLeadLen:
-            leads[index].xs.append(None)
-            leads[index].ys.append(None)
-            currLen += 1
-
-    return leads
-
-
 # returns a list [vLineXs, syncLineXs, hLineYs]
 def is_data_complete_and_valid():
     unreadySteps = getUnreadySteps()
@@ -1313,16 +1283,11 @@ def is_data_complete_and_valid():
     syncLineXs = sync_lines.getXs()
 
     # validate syncLineXs
-    if len(vLineXs) is not len(syncLineXs) + 1:
-        remindWindow('Wait...', 'Invalid synchronization lines. Should have one less than vertical lines')
+    msg = ecg_engine.checkLines(vLineXs, syncLineXs)
+    if msg is not None:
+        remindWindow('Wait...', msg)
         return ret
 
-    for i in range(len(syncLineXs)):
-        if syncLineXs[i] < vLineXs[i] or syncLineXs[i] > vLineXs[i + 1]:
-            remindWindow('Wait...',
-                         'Invalid synchronization lines. Each sync line should be between two vertical lines')
-            return ret
-
     hLineYs = h_lines.getYs()
     ret.append(vLineXs)
     ret.append(syncLineXs)
@@ -1335,6 +1300,8 @@ def saveCallBack():
     if not dataLoaded:
         remindLoadingData()
         return
+    if isBusy():
+        return
 
     ret = is_data_complete_and_valid()
     if len(ret) == 0:
@@ -1350,9 +1317,16 @@ def saveCallBack():
     if fd is None:
         return
 
-    preSaveDataProcess(fd, vLineXs, syncLineXs, hLineYs)
+    def failed():
+        fd.close()
+        discardFile(fd.name)
+
+    worker.run('Saving', lambda progress: preSaveDataProcess(fd, vLineXs, syncLineXs, hLineYs, progress),
+               on_fail=failed)
 
 def saveROICallBack():
+    if isBusy():
+        return
     if not XYs.is_ROI_ready():
         remindWindow('Wait...', 'no ROI selected')
         return
@@ -1360,7 +1334,123 @@ def saveROICallBack():
     fd = asksaveasfile(mode='w', defaultextension=".csv")
     if fd is None:
         return
-    XYs.save_ROI_regions(fd)
+
+    def failed():
+        fd.close()
+        discardFile(fd.name)
+
+    worker.run('Saving ROI', lambda progress: XYs.save_ROI_regions(fd, progress), on_fail=failed)
+
+def exportCallBack():
+    if not dataLoaded:
+        remindLoadingData()
+        return
+    if isBusy():
+        return
+
+    ret = is_data_complete_and_valid()
+    if len(ret) == 0:
+        return
+    if len(ret) != 3:
+        print 'is_data_complete_and_valid() does not return properly!'
+        assert False
+
+    fileName = asksaveasfilename(defaultextension=".npz", filetypes=[('NumPy archive', '*.npz')])
+    if not fileName:
+        return
+
+    # the ROIs go in as well if they are marked
+    worker.run('Exporting',
+               lambda progress: ecg_engine.exportNPZ(fileName, ret[0], ret[1], ret[2], XYs, cali_info, progress),
+               on_fail=lambda: discardFile(fileName))
+
+#                    _
+#  ___  ___  ___ ___(_) ___  _ __
+# / __|/ _ \/ __/ __| |/ _ \| '_ \
+# \__ \  __/\__ \__ \ | (_) | | | |
+# |___/\___||___/___/_|\___/|_| |_|
+#
+#
+# The markers of a study are saved to ecg_annotation.json next to its .dat
+# files, the file ecg_engine.py and ecg_batch.py read, and are put back when
+# the study is loaded again
+def getSessionFile():
+    return os.path.join(os.path.dirname(XYs.sourceFiles[0]), ecg_engine.ANNOTATION_FILE_NAME)
+
+
+def saveSessionCallBack():
+    if not dataLoaded:
+        remindLoadingData()
+        return
+    if isBusy():
+        return
+
+    vLineXs = v_lines.getXs()
+    syncLineXs = sync_lines.getXs()
+    # deleting a line leaves the ROIs marked, they are only saved with all lines in place
+    roi = None
+    if XYs.ROIWindow is not None and v_lines.vLinesReady() and sync_lines.vSyncLinesReady() \
+            and ecg_engine.checkLines(vLineXs, syncLineXs) is None:
+        roi = ecg_engine.getROIRange(vLineXs, syncLineXs, XYs.ROIWindow)
+
+    # a box whose factors were not entered yet is not saved
+    annotation = ecg_engine.makeAnnotation(cali_info if cali_info.caliInfoReady() else None,
+                                           vLineXs, syncLineXs, h_lines.getYs(), XYs.isInverted, roi)
+    if annotation['calibration'] is not None:
+        annotation['calibration']['x'] = cali_info.handle.get_x()
+        annotation['calibration']['y'] = cali_info.handle.get_y()
+
+    try:
+        ecg_engine.writeAnnotation(getSessionFile(), annotation)
+    except IOError as e:
+        remindWindow('Error!', 'Cannot save the session: ' + str(e))
+        return
+    progressText.set('Session saved')
+
+
+def restoreSessionFile():
+    sessionFile = getSessionFile()
+    if not os.path.exists(sessionFile):
+        return
+
+    try:
+        annotation = ecg_engine.readAnnotation(sessionFile)
+    except (IOError, ValueError) as e:
+        remindWindow('Error!', 'Cannot restore the session: ' + str(e))
+        return
+    restoreSession(annotation)
+    progressText.set('Session restored')
+
+
+# puts the markers of annotation on a freshly loaded study. Every marker only
+# asks for a redraw, so the plot is rendered once when Tk is idle again
+def restoreSession(annotation):
+    if annotation['inverted'] != XYs.isInverted:
+        XYs.invert()
+
+    calibration = annotation['calibration']
+    if calibration is not None:
+        addCaliRect(calibration.get('x', XYs.allXmin), calibration.get('y', XYs.allYmin),
+                    calibration['deltaX'], calibration['deltaY'])
+        cali_info.setCaliFactor([calibration['voltage'], calibration['time']])
+
+    for x in annotation['vLines']:
+        addVerticalLine(x)
+    for x in annotation['syncLines']:
+        addSyncLine(x)
+    for y in annotation['hLines']:
+        addHorizontalLine(y)
+
+    # carry on with the first step that is not finished
+    unreadySteps = getUnreadySteps()
+    step = STEP_FIVE
+    if len(unreadySteps) != 0:
+        step = unreadySteps[0]
+    elif annotation['roi'] is not None:
+        XYs.ROI_ready_to_save = validate_and_mark_ROI_regions(min(annotation['roi']), max(annotation['roi']))
+
+    selectedOp.set(userModes[step])
+    selectOpCallBack(None)
 
 def restartCallBack():
     # delete all existing objects
@@ -1368,6 +1458,8 @@ def restartCallBack():
     if not dataLoaded:
         remindLoadingData()
         return
+    if isBusy():
+        return
 
     cali_info.deleteRect()
     v_lines.deleteAll()
@@ -1381,7 +1473,8 @@ def restartCallBack():
     selectedOp.set(userModes[STEP_ONE])
     selectOpCallBack(None)
 
-if __name__ == "__main__":
+# the buttons under the plot and the switches of the five steps
+def buildControls():
     browseButton = Tk.Button(master=root, text="Set Data Folder", command=browseCallBack)
     browseButton.pack(side=Tk.LEFT)
 
@@ -1406,9 +1499,21 @@ if __name__ == "__main__":
     saveROIButton = Tk.Button(master=root, text="Save ROI", command=saveROICallBack)
     saveROIButton.pack(side=Tk.LEFT)
 
+    exportButton = Tk.Button(master=root, text="Export", command=exportCallBack)
+    exportButton.pack(side=Tk.LEFT)
+
+    saveSessionButton = Tk.Button(master=root, text="Save Session", command=saveSessionCallBack)
+    saveSessionButton.pack(side=Tk.LEFT)
+
     restartButton = Tk.Button(master=root, text="Restart", command=restartCallBack)
     restartButton.pack(side=Tk.LEFT)
 
+    cancelButton = Tk.Button(master=root, text="Cancel", command=worker.cancel)
+    cancelButton.pack(side=Tk.LEFT)
+
+    progressLabel = Tk.Label(master=root, textvariable=progressText)
+    progressLabel.pack(side=Tk.LEFT)
+
     # initialize global variables
     enablers[STEP_ONE] = enableRectSelector
     enablers[STEP_TWO] = enableDrawVertLine
@@ -1421,4 +1526,9 @@ if __name__ == "__main__":
     disablers[STEP_THREE] = disableDrawSyncLine
     disablers[STEP_FOUR] = disableDrawHorizontalLine
     disablers[STEP_FIVE] = disableDrawROI
+
+
+if __name__ == "__main__":
+    createApp()
+    buildControls()
     Tk.mainloop()
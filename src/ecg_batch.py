@@ -0,0 +1,225 @@
+'''
+Run the headless pipeline of ecg_engine over a whole tree of study folders on
+all CPU cores:
+
+python ecg_batch.py <root dir> [--out <output dir>] [--jobs N] [--manifest batch_manifest.json] [--rate HZ] [--profile]
+                    [--timeout SECONDS]
+
+Every folder with .dat files in it is a study. Each study runs in a child
+process of its own, so a broken study is recorded in the manifest as a failure
+and the rest of the run goes on. That includes a child that dies (killed for
+running out of memory, a crash in numpy) or runs longer than --timeout.
+'''
+import sys
+import os
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+import ecg_engine
+from ecg_engine import EXIT_SUCCESS, EXIT_FAILURE
+
+MANIFEST_FILE_NAME = 'batch_manifest.json'
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+POLL_SECONDS = 0.05  # how often the running children are checked
+
+
+# returns all study folders under root_dir, sorted so runs are repeatable
+def findStudies(root_dir):
+    studies = []
+    for dir_name, sub_dirs, file_names in os.walk(root_dir):
+        # never descend into our own caches
+        sub_dirs[:] = [d for d in sub_dirs if d != ecg_engine.DAT_CACHE_DIR]
+        if any('.dat' in fn for fn in file_names):
+            studies.append(dir_name)
+    studies.sort()
+    return studies
+
+
+# where the CSVs of a study go: next to the inputs, or mirrored under out_dir
+def getOutputDir(study_dir, root_dir, out_dir):
+    if out_dir is None:
+        return study_dir
+    return os.path.join(out_dir, os.path.relpath(study_dir, root_dir))
+
+
+def newResult(study_dir):
+    return {'study': study_dir, 'status': STATUS_FAILED, 'seconds': 0.0, 'error': None,
+            'leads': None, 'roi': None, 'profile': None}
+
+
+# runs in a child process. Never raises, every problem ends up in the result
+def runStudy(job):
+    study_dir, output_dir, sample_rate = job
+    result = newResult(study_dir)
+    start = time.time()
+    # a forked child starts with the records of its parent
+    ecg_engine.profiler.reset()
+    try:
+        annotation = ecg_engine.loadAnnotation(os.path.join(study_dir, ecg_engine.ANNOTATION_FILE_NAME))
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        leadsFile = os.path.join(output_dir, ecg_engine.LEADS_FILE_NAME)
+        roiFile = os.path.join(output_dir, ecg_engine.ROI_FILE_NAME)
+        ecg_engine.processStudy(study_dir, annotation, leadsFile, roiFile, sample_rate=sample_rate)
+        result['leads'] = leadsFile
+        if annotation['roi'] is not None:
+            result['roi'] = roiFile
+        result['status'] = STATUS_OK
+    except Exception as e:
+        # the asserts in OneRowXY/ROI end up here as well
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = time.time() - start
+
+    if ecg_engine.profiler.enabled and os.path.isdir(output_dir):
+        profileFile = os.path.join(output_dir, ecg_engine.PROFILE_FILE_NAME)
+        ecg_engine.profiler.writeReport(profileFile, {'study': study_dir, 'status': result['status']})
+        result['profile'] = profileFile
+    return result
+
+
+# the child process of one study, sends the result back through conn
+def runStudyChild(job, conn):
+    conn.send(runStudy(job))
+    conn.close()
+
+
+# One child per study, at most jobs of them at a time. A pool worker that dies
+# takes its task with it and the pool waits for it forever, so the children are
+# watched here: one that exits without a result or runs out of time is recorded
+# as a failed study. A fresh process per study also keeps a leaking study from
+# slowing down the rest
+def runChildren(allJobs, jobs=None, timeout=None):
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    waiting = list(allJobs)
+    running = []  # [job, process, conn, start]
+    results = []
+    try:
+        while len(waiting) != 0 or len(running) != 0:
+            while len(waiting) != 0 and len(running) < jobs:
+                job = waiting.pop(0)
+                parentConn, childConn = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(target=runStudyChild, args=(job, childConn))
+                process.daemon = True
+                process.start()
+                childConn.close()
+                running.append([job, process, parentConn, time.time()])
+
+            for child in list(running):
+                job, process, conn, start = child
+                # a child that is gone has sent all it ever will
+                alive = process.is_alive()
+                result = None
+                if conn.poll():
+                    try:
+                        result = conn.recv()
+                    except EOFError:  # its end of the pipe closed without a result
+                        alive = False
+
+                timedOut = False
+                if result is None and alive:
+                    if timeout is None or time.time() - start <= timeout:
+                        continue
+                    process.terminate()
+                    timedOut = True
+
+                process.join()
+                conn.close()
+                running.remove(child)
+                if result is None:
+                    result = newResult(job[0])
+                    result['seconds'] = time.time() - start
+                    if timedOut:
+                        result['error'] = 'timed out after {0}s'.format(timeout)
+                    else:
+                        result['error'] = 'worker exited with code {0}'.format(process.exitcode)
+                results.append(result)
+                print '[{0}/{1}] {2} {3:.2f}s {4}'.format(len(results), len(allJobs), result['status'],
+                                                         result['seconds'], result['study'])
+                if result['error'] is not None:
+                    print '    ' + result['error']
+                sys.stdout.flush()
+
+            time.sleep(POLL_SECONDS)
+    except KeyboardInterrupt:
+        for job, process, conn, start in running:
+            process.terminate()
+            process.join()
+        raise
+    return results
+
+
+def runBatch(root_dir, out_dir=None, jobs=None, manifest_file=None, sample_rate=None, timeout=None):
+    studies = findStudies(root_dir)
+    allJobs = [(study, getOutputDir(study, root_dir, out_dir), sample_rate) for study in studies]
+    if manifest_file is None:
+        manifest_file = os.path.join(out_dir or root_dir, MANIFEST_FILE_NAME)
+
+    start = time.time()
+    results = runChildren(allJobs, jobs, timeout)
+
+    results.sort(key=lambda r: r['study'])
+    failed = [r for r in results if r['status'] != STATUS_OK]
+    manifest = {
+        'root': root_dir,
+        'sampleRate': sample_rate,
+        'timeout': timeout,
+        'total': len(results),
+        'succeeded': len(results) - len(failed),
+        'failed': len(failed),
+        'seconds': time.time() - start,
+        'studies': results,
+    }
+    manifestDir = os.path.dirname(os.path.abspath(manifest_file))
+    if not os.path.isdir(manifestDir):
+        os.makedirs(manifestDir)
+    with open(manifest_file, 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+
+    print '{0} studies, {1} succeeded, {2} failed in {3:.1f}s. Manifest: {4}'.format(
+        manifest['total'], manifest['succeeded'], manifest['failed'], manifest['seconds'], manifest_file)
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Split every study under a folder into leads without the GUI')
+    parser.add_argument('root_dir', help='folder to search for studies')
+    parser.add_argument('--out', default=None, help='write the CSVs here instead of into each study folder')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--manifest', default=None,
+                        help='summary file (default: <out or root_dir>/' + MANIFEST_FILE_NAME + ')')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='resample the leads and ROIs to this many samples per second')
+    parser.add_argument('--profile', action='store_true',
+                        help='write the time, samples and memory of each stage of a study to '
+                             + ecg_engine.PROFILE_FILE_NAME + ' next to its CSVs (same as '
+                             + ecg_engine.PROFILE_ENV + '=1)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds a study may take before it is stopped and recorded as failed')
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        # the environment carries it over to children that are not forked
+        os.environ[ecg_engine.PROFILE_ENV] = '1'
+        ecg_engine.profiler.enabled = True
+
+    if args.jobs is not None and args.jobs < 1:
+        print >> sys.stderr, 'Error! --jobs must be positive'
+        return EXIT_FAILURE
+
+    if not os.path.isdir(args.root_dir):
+        print >> sys.stderr, 'Error! No such a directory:', args.root_dir
+        return EXIT_FAILURE
+
+    manifest = runBatch(args.root_dir, args.out, args.jobs, args.manifest, args.rate, args.timeout)
+    if manifest['failed'] != 0:
+        return EXIT_FAILURE
+    return EXIT_SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(main())
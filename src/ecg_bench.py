@@ -0,0 +1,291 @@
+'''
+Benchmarks of the engine on synthetic studies, no display needed:
+
+python ecg_bench.py [--sizes 10000 100000 1000000] [--repeat 3] [--work <dir>] [--out bench.json]
+
+Every size is the number of samples per row of a generated four-file study.
+The studies are generated once and kept in the work folder, so later runs time
+exactly the same data. Each benchmark of each size runs in a fresh process, so
+the peak memory of one benchmark does not hide the next one.
+'''
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import ecg_engine
+from ecg_engine import EXIT_SUCCESS, EXIT_FAILURE
+
+DEFAULT_SIZES = [10000, 100000, 1000000]
+FULL_SIZES = [10000, 100000, 1000000, 10000000]
+DEFAULT_REPEAT = 3
+DEFAULT_SEED = 0
+ROW_BASELINES = [0.0, 300.0, 600.0, 900.0]  # keeps the rows in the same order after sorting
+BEAT_SAMPLES = 700.0  # samples per heart beat
+
+
+#                                  _
+#   __ _  ___ _ __   ___ _ __ __ _| |_ ___
+#  / _` |/ _ \ '_ \ / _ \ '__/ _` | __/ _ \
+# | (_| |  __/ | | |  __/ | | (_| | ||  __/
+#  \__, |\___|_| |_|\___|_|  \__,_|\__\___|
+#  |___/
+#
+# a row looks like a traced paper ECG: x only grows, sometimes not at all
+# (several ys at the same x), and y is a train of P, QRS and T waves plus noise
+def generateRow(samples, baseline, rng):
+    steps = rng.choice([0.0, 0.5, 1.0, 1.25], size=samples, p=[0.3, 0.3, 0.3, 0.1])
+    xs = np.cumsum(steps)
+
+    phase = (np.arange(samples) % BEAT_SAMPLES) / BEAT_SAMPLES
+    ys = (8.0 * np.exp(-((phase - 0.2) / 0.03) ** 2)     # P
+          - 6.0 * np.exp(-((phase - 0.38) / 0.008) ** 2)   # Q
+          + 60.0 * np.exp(-((phase - 0.4) / 0.01) ** 2)    # R
+          - 12.0 * np.exp(-((phase - 0.42) / 0.01) ** 2)   # S
+          + 15.0 * np.exp(-((phase - 0.65) / 0.06) ** 2))  # T
+    ys += baseline + rng.uniform(-2.0, 2.0, size=samples)
+    return xs, np.round(ys, 3)
+
+
+def getStudyDir(work_dir, samples, seed):
+    return os.path.join(work_dir, 'study_{0}_{1}'.format(samples, seed))
+
+
+# writes the study unless it is there already, returns its folder
+def generateStudy(work_dir, samples, seed=DEFAULT_SEED):
+    studyDir = getStudyDir(work_dir, samples, seed)
+    doneFile = os.path.join(studyDir, 'complete')
+    if os.path.exists(doneFile):
+        return studyDir
+
+    if os.path.isdir(studyDir):
+        shutil.rmtree(studyDir)
+    os.makedirs(studyDir)
+    rng = np.random.RandomState(seed)
+    for rowIndex, baseline in enumerate(ROW_BASELINES):
+        xs, ys = generateRow(samples, baseline, rng)
+        np.savetxt(os.path.join(studyDir, 'row{0}.dat'.format(rowIndex)), np.column_stack((xs, ys)),
+                   fmt='%.2f %.3f')
+    open(doneFile, 'w').close()
+    return studyDir
+
+
+# the lines an operator would mark on a loaded study: 5 vertical lines over the
+# whole x range, a sync line in the middle of each lead, one zero line per lead
+# row and an ROI just before the first sync line
+def getAnnotation(all_rows):
+    xMin = all_rows.allXmin
+    xMax = all_rows.allXmax
+    leadWidth = (xMax - xMin) / 4.0
+    vLineXs = [xMin + leadWidth * (i + 0.02) for i in range(4)] + [xMax - leadWidth * 0.02]
+    syncLineXs = [(vLineXs[i] + vLineXs[i + 1]) / 2.0 for i in range(4)]
+    hLineYs = sorted(row.yAve for row in all_rows.getCurrentPlotedXYs()[1:])
+    roi = [syncLineXs[0] - leadWidth * 0.3, syncLineXs[0] - leadWidth * 0.05]
+    return {
+        'calibration': {'deltaX': 25.0, 'deltaY': 40.0, 'voltage': 1, 'time': 0.2},
+        'inverted': False,
+        'vLines': vLineXs,
+        'syncLines': syncLineXs,
+        'hLines': hLineYs,
+        'roi': roi,
+    }
+
+
+#  _                     _                          _
+# | |__   ___ _ __   ___| |__  _ __ ___   __ _ _ __| | __
+# | '_ \ / _ \ '_ \ / __| '_ \| '_ ` _ \ / _` | '__| |/ /
+# | |_) |  __/ | | | (__| | | | | | | | | (_| | |  |   <
+# |_.__/ \___|_| |_|\___|_| |_|_| |_| |_|\__,_|_|  |_|\_\
+#
+#
+# runs setup() then func(*setup()) repeat times, only func is timed
+def timeRuns(func, setup, repeat):
+    runs = []
+    for i in range(repeat):
+        args = setup()
+        start = time.time()
+        func(*args)
+        runs.append(time.time() - start)
+    return runs
+
+
+def getResult(name, samples, runs, peak_before):
+    best = min(runs)
+    peak = ecg_engine.getPeakMemoryKB()
+    return {
+        'benchmark': name,
+        'samples': samples,
+        'runs': runs,
+        'seconds': best,
+        'samplesPerSecond': samples / best if best > 0 else None,
+        # every benchmark runs in a fresh process: its peak and how much the
+        # timed runs raised it
+        'peakMemoryKB': peak,
+        'memoryRiseKB': peak - peak_before if peak is not None else None,
+    }
+
+
+def loadRows(allXYs):
+    all_rows = ecg_engine.AllRows()
+    for xs, ys in allXYs:
+        all_rows.addRow(xs, ys)
+    return all_rows
+
+
+BENCHMARKS = ['readXYfromFile (text)', 'readXYfromFile (cached)', 'AllRows.finishLoading', 'splitOneRow',
+              'AllRows.mark_ROI_regions', 'preSaveDataProcess', 'save_ROI_regions']
+
+
+# one benchmark of one study size. Runs in a process of its own, so its peak
+# memory is not the one of a benchmark before it
+def runBenchmark(job):
+    name, samples, work_dir, repeat, seed = job
+    studyDir = getStudyDir(work_dir, samples, seed)
+    datFiles = sorted(ecg_engine.getDatFiles(studyDir))
+    cacheDir = os.path.join(studyDir, ecg_engine.DAT_CACHE_DIR)
+    outFile = os.path.join(studyDir, 'bench_out.csv')
+    rowSamples = samples * len(datFiles)
+    leadSamples = samples * 3  # the reference row is not split
+
+    def dropCache():
+        if os.path.isdir(cacheDir):
+            shutil.rmtree(cacheDir)
+        return []
+
+    def readAll():
+        for fileName in datFiles:
+            ecg_engine.readXYfromFile(fileName)
+
+    def timeIt(func, setup, samples):
+        peakBefore = ecg_engine.getPeakMemoryKB()
+        return getResult(name, samples, timeRuns(func, setup, repeat), peakBefore)
+
+    if name == 'readXYfromFile (text)':
+        return timeIt(readAll, dropCache, rowSamples)
+    if name == 'readXYfromFile (cached)':
+        readAll()  # makes sure the cache is there
+        return timeIt(readAll, lambda: [], rowSamples)
+
+    allXYs = [ecg_engine.readXYArraysCached(fileName) for fileName in datFiles]
+    if name == 'AllRows.finishLoading':
+        return timeIt(lambda all_rows: all_rows.finishLoading(), lambda: [loadRows(allXYs)], rowSamples)
+
+    all_rows = loadRows(allXYs)
+    all_rows.finishLoading()
+    annotation = getAnnotation(all_rows)
+    cali_info = ecg_engine.getCaliInfo(annotation)
+    vLineXs = annotation['vLines']
+    syncLineXs = annotation['syncLines']
+    hLineYs = annotation['hLines']
+    leadRows = list(reversed(all_rows.getCurrentPlotedXYs()[1:]))
+    window = ecg_engine.findROIWindow(vLineXs, syncLineXs, annotation['roi'][0], annotation['roi'][1])
+
+    def splitRows():
+        for row, yOffset in zip(leadRows, reversed(hLineYs)):
+            ecg_engine.splitOneRow(row, vLineXs, syncLineXs, yOffset, cali_info)
+
+    def markROIs():
+        all_rows.mark_ROI_regions(window[0], window[1], syncLineXs, hLineYs, cali_info)
+
+    def clearROIs():
+        all_rows.deleteROIs()
+        return []
+
+    def openOut():
+        return [open(outFile, 'w')]
+
+    try:
+        if name == 'splitOneRow':
+            return timeIt(splitRows, lambda: [], leadSamples)
+        if name == 'AllRows.mark_ROI_regions':
+            return timeIt(markROIs, clearROIs, leadSamples)
+        if name == 'preSaveDataProcess':
+            return timeIt(lambda fd: ecg_engine.preSaveDataProcess(fd, vLineXs, syncLineXs, hLineYs, all_rows,
+                                                                   cali_info), openOut, leadSamples)
+        if name == 'save_ROI_regions':
+            markROIs()
+            roiSamples = sum(len(roi.get_transformed_xs()) for roi in all_rows.ROIs)
+            return timeIt(lambda fd: all_rows.save_ROI_regions(fd), openOut, roiSamples)
+    finally:
+        if os.path.exists(outFile):
+            os.remove(outFile)
+    raise ValueError('Unknown benchmark: ' + name)
+
+
+# all benchmarks of one study size, each in a fresh process
+def runSize(samples, work_dir, repeat, seed):
+    pool = multiprocessing.Pool(processes=1, maxtasksperchild=1)
+    try:
+        studyDir = pool.apply(generateStudy, [work_dir, samples, seed])
+        results = pool.map(runBenchmark, [(name, samples, work_dir, repeat, seed) for name in BENCHMARKS],
+                           chunksize=1)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return {'samplesPerRow': samples, 'study': studyDir, 'results': results}
+
+
+def getEnvironment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': multiprocessing.cpu_count(),
+    }
+
+
+def runBench(sizes, work_dir, repeat=DEFAULT_REPEAT, seed=DEFAULT_SEED):
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    report = {'environment': getEnvironment(), 'repeat': repeat, 'seed': seed, 'sizes': []}
+    for samples in sizes:
+        print 'generating and timing {0} samples per row...'.format(samples)
+        sys.stdout.flush()
+        sizeReport = runSize(samples, work_dir, repeat, seed)
+        for result in sizeReport['results']:
+            print '    {0:<26} {1:9.4f}s {2:>14} samples/s {3:>10} KB peak {4:>10} KB rise'.format(
+                result['benchmark'], result['seconds'],
+                '{0:,.0f}'.format(result['samplesPerSecond'] or 0), result['peakMemoryKB'], result['memoryRiseKB'])
+        sys.stdout.flush()
+        report['sizes'].append(sizeReport)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the engine on synthetic studies')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None,
+                        help='samples per row (default: ' + ' '.join(str(n) for n in DEFAULT_SIZES) + ')')
+    parser.add_argument('--full', action='store_true',
+                        help='use sizes up to 10M samples per row: ' + ' '.join(str(n) for n in FULL_SIZES))
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='runs per benchmark, the best one counts')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='seed of the generated studies')
+    parser.add_argument('--work', default=os.path.join(tempfile.gettempdir(), 'ecg_bench'),
+                        help='where the generated studies are kept')
+    parser.add_argument('--out', default=None, help='also write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (FULL_SIZES if args.full else DEFAULT_SIZES)
+    if args.repeat < 1 or min(sizes) < 1:
+        print >> sys.stderr, 'Error! --repeat and --sizes must be positive'
+        return EXIT_FAILURE
+
+    report = runBench(sizes, args.work, args.repeat, args.seed)
+    if args.out is not None:
+        with open(args.out, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+        print 'Results:', args.out
+    return EXIT_SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1521 @@
+'''
+Processing core of the ECG Analyzer. Nothing in here touches Tk or matplotlib,
+so it can be used by the GUI as well as on servers without a display:
+
+python ecg_engine.py <study dir> <annotation file> [--leads out.csv] [--roi out_roi.csv] [--npz out.npz] [--rate HZ]
+                     [--profile profile.json] [--cprofile run.pstats]
+'''
+import sys
+import os
+import csv
+import json
+import hashlib
+import logging
+import time
+import itertools
+import threading
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+DAT_FILE_NUM = 4
+DAT_CACHE_DIR = '.ecg_cache'  # binary copies of the .dat files, kept next to them
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+
+VerticalLineNum = 5
+HorizontalLineNum = 3
+
+ANNOTATION_FILE_NAME = 'ecg_annotation.json'
+LEADS_FILE_NAME = 'leads.csv'
+ROI_FILE_NAME = 'roi.csv'
+
+save_data_lead_names = ["I", "aVR", "V1", "V4",
+             "II", "aVL", "V2", "V5",
+             "III", "aVF", "V3", "V6"]
+
+
+# raised from a progress callback to stop a long operation part way through
+class OperationCancelled(Exception):
+    pass
+
+
+# long operations take an optional progress callback, called as
+# progress(done, total). It may raise OperationCancelled
+def reportProgress(progress, done, total):
+    if progress is not None:
+        progress(done, total)
+
+
+#                   __ _ _
+#  _ __  _ __ ___  / _(_) | ___
+# | '_ \| '__/ _ \| |_| | |/ _ \
+# | |_) | | | (_) |  _| | |  __/
+# | .__/|_|  \___/|_| |_|_|\___|
+# |_|
+#
+# Records the wall time, the number of samples and the memory of every run of
+# each stage (parse, addRow, finishLoading, splitOneRow, ...). Off unless
+# ECG_PROFILE is set (to anything but 0) or a --profile flag turns it on. When
+# it is off a stage costs one attribute lookup.
+# The memory of a stage is how far it raised the peak of the process
+# (memoryRiseKB). A stage that stays below an earlier peak shows 0, so the
+# peak of the process is recorded as well (processPeakMemoryKB)
+PROFILE_ENV = 'ECG_PROFILE'
+PROFILE_FILE_NAME = 'ecg_profile.json'
+
+
+# peak resident memory of the process so far in KB, None where it is unknown
+def getPeakMemoryKB():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # bytes there
+        peak //= 1024
+    return peak
+
+
+class StageProfiler(object):
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.records = []
+            self.startTime = time.time()
+
+    # with profiler.stage('name', samples) as stage: ... The samples can also
+    # be set on stage inside the block, once they are known
+    def stage(self, name, samples=0):
+        if not self.enabled:
+            return NullStage()
+        return ProfiledStage(self, name, samples)
+
+    def addRecord(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    # the totals of each stage in the order they first ran, plus every run
+    def getReport(self, extra=None):
+        with self.lock:
+            records = list(self.records)
+            seconds = time.time() - self.startTime
+
+        stages = []
+        byName = {}
+        for record in records:
+            if record['stage'] not in byName:
+                byName[record['stage']] = {'stage': record['stage'], 'calls': 0, 'seconds': 0.0,
+                                           'maxSeconds': 0.0, 'samples': 0, 'maxMemoryRiseKB': None}
+                stages.append(byName[record['stage']])
+            total = byName[record['stage']]
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            total['maxSeconds'] = max(total['maxSeconds'], record['seconds'])
+            total['samples'] += record['samples']
+            if record['memoryRiseKB'] is not None:
+                total['maxMemoryRiseKB'] = max(total['maxMemoryRiseKB'], record['memoryRiseKB'])
+
+        report = {'seconds': seconds, 'processPeakMemoryKB': getPeakMemoryKB(), 'pid': os.getpid(),
+                  'stages': stages, 'records': records}
+        if extra is not None:
+            report.update(extra)
+        return report
+
+    def writeReport(self, file_name, extra=None):
+        with open(file_name, 'w') as fp:
+            json.dump(self.getReport(extra), fp, indent=2, sort_keys=True)
+
+
+class ProfiledStage(object):
+
+    def __init__(self, profiler, name, samples):
+        self.profiler = profiler
+        self.name = name
+        self.samples = samples
+
+    def __enter__(self):
+        self.begin = time.time()
+        self.beginPeak = getPeakMemoryKB()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        peak = getPeakMemoryKB()
+        memoryRise = None
+        if peak is not None:
+            memoryRise = peak - self.beginPeak
+        self.profiler.addRecord({'stage': self.name, 'seconds': time.time() - self.begin,
+                                 'samples': int(self.samples), 'memoryRiseKB': memoryRise,
+                                 'processPeakMemoryKB': peak, 'thread': threading.current_thread().name,
+                                 'failed': exc_type is not None})
+        return False
+
+
+class NullStage(object):
+    samples = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        return False
+
+
+profiler = StageProfiler(os.environ.get(PROFILE_ENV, '0') not in ('', '0'))
+
+
+# call func(*args) under cProfile and save the statistics to stats_file
+# (read them with the pstats module)
+def runWithCProfile(stats_file, func, *args):
+    import cProfile
+    cProfiler = cProfile.Profile()
+    try:
+        return cProfiler.runcall(func, *args)
+    finally:
+        cProfiler.dump_stats(stats_file)
+
+
+#  _                 _
+# | | ___   __ _  __| |
+# | |/ _ \ / _` |/ _` |
+# | | (_) | (_| | (_| |
+# |_|\___/ \__,_|\__,_|
+#
+def readXYfromFileByLine(file_name):
+    xs = []
+    ys = []
+    with open(file_name) as fp:
+        for line in fp:
+            xyStr = line.split()
+            xs.append(float(xyStr[0]))
+            ys.append(float(xyStr[1]))
+    return xs, ys
+
+
+# np.fromstring only counts the numbers of the whole file, so a ragged file
+# whose counts happen to add up would be read shifted. Every line holds
+# col_num fields if k * col_num fields start before the k-th newline
+def hasColumns(text, col_num):
+    chars = np.frombuffer(text, dtype=np.uint8)
+    isSpace = (chars == ord(' ')) | ((chars >= ord('\t')) & (chars <= ord('\r')))  # what split() splits on
+    afterSpace = np.empty_like(isSpace)
+    afterSpace[0] = True
+    afterSpace[1:] = isSpace[:-1]
+    fieldStarts = np.flatnonzero(~isSpace & afterSpace)
+    newlines = np.flatnonzero(chars == ord('\n'))
+    fieldsBefore = np.searchsorted(fieldStarts, newlines)
+    return np.array_equal(fieldsBefore, col_num * np.arange(1, len(newlines) + 1))
+
+
+# parse the whole file in one go and return two contiguous float arrays
+# falls back to the line by line parser if the file is not a clean table of numbers
+def readXYArraysFromFile(file_name):
+    with open(file_name) as fp:
+        text = fp.read()
+
+    firstLine = text.split('\n', 1)[0]
+    colNum = len(firstLine.split())
+    lineNum = text.count('\n')
+    if len(text) > 0 and not text.endswith('\n'):
+        lineNum += 1
+
+    values = None
+    if colNum >= 2:
+        values = np.fromstring(text, dtype=np.float64, sep=' ')
+
+    if values is None or values.size != colNum * lineNum or not hasColumns(text, colNum):
+        # blank lines, ragged lines or junk in the file
+        xs, ys = readXYfromFileByLine(file_name)
+        return np.array(xs, dtype=np.float64), np.array(ys, dtype=np.float64)
+
+    values = values.reshape(lineNum, colNum)
+    xs = np.ascontiguousarray(values[:, 0])
+    ys = np.ascontiguousarray(values[:, 1])
+    return xs, ys
+
+
+# the cache file name is keyed on the path, size and mtime of the .dat file,
+# so any change to the source file makes the old cache entry unreachable
+def getDatCachePath(file_name):
+    st = os.stat(file_name)
+    key = u'{0}|{1}|{2!r}'.format(os.path.abspath(file_name), st.st_size, st.st_mtime)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    cacheDir = os.path.join(os.path.dirname(os.path.abspath(file_name)), DAT_CACHE_DIR)
+    return os.path.join(cacheDir, os.path.basename(file_name) + '.' + digest + '.npy')
+
+
+def writeDatCache(file_name, cache_file, xs, ys):
+    cacheDir = os.path.dirname(cache_file)
+    try:
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        # drop stale entries of the same .dat file
+        prefix = os.path.basename(file_name) + '.'
+        for fn in os.listdir(cacheDir):
+            if fn.startswith(prefix) and fn.endswith('.npy'):
+                os.remove(os.path.join(cacheDir, fn))
+        tmpFile = cache_file + '.tmp'
+        with open(tmpFile, 'wb') as fp:
+            np.save(fp, np.vstack((xs, ys)))
+        os.rename(tmpFile, cache_file)
+    except (IOError, OSError) as e:
+        # read-only study folders are fine, we just parse the text next time
+        logging.debug('cannot write cache for %s: %s', file_name, e)
+
+
+# returns memory-mapped arrays if an up-to-date cache exists, otherwise parses
+# the .dat file and writes the cache for next time
+def readXYArraysCached(file_name):
+    with profiler.stage('parse') as stage:
+        cacheFile = getDatCachePath(file_name)
+        xy = None
+        if os.path.exists(cacheFile):
+            try:
+                xy = np.load(cacheFile, mmap_mode='r')
+                if xy.ndim != 2 or xy.shape[0] != 2:
+                    xy = None
+            except (IOError, ValueError) as e:
+                logging.debug('ignoring broken cache %s: %s', cacheFile, e)
+                xy = None
+
+        if xy is not None:
+            xs, ys = xy[0], xy[1]
+        else:
+            xs, ys = readXYArraysFromFile(file_name)
+            writeDatCache(file_name, cacheFile, xs, ys)
+        stage.samples = len(xs)
+    return xs, ys
+
+
+def readXYfromFile(file_name):
+    xs, ys = readXYArraysCached(file_name)
+    return xs.tolist(), ys.tolist()
+
+
+# returns the full paths of the .dat files in dir_name. Raises OSError if the
+# directory does not exist
+def getDatFiles(dir_name):
+    allInputFiles = os.listdir(dir_name)
+    allInputFiles = list(filter(lambda fn: ('.dat' in fn), allInputFiles))
+    return list(map(lambda fn: (dir_name + '/' + fn), allInputFiles))
+
+
+# read all files at the same time. map() keeps the results in the order of
+# file_names so the rows are always added in the same order
+def readAllDatFiles(file_names, progress=None):
+    # imported here, it is a good part of the import time of this module
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(len(file_names))
+    try:
+        allXYs = []
+        reportProgress(progress, 0, len(file_names))
+        for xys in pool.imap(readXYArraysCached, file_names):
+            allXYs.append(xys)
+            reportProgress(progress, len(allXYs), len(file_names))
+        return allXYs
+    finally:
+        pool.close()
+        pool.join()
+
+
+#      _       _
+#   __| | __ _| |_ __ _
+#  / _` |/ _` | __/ _` |
+# | (_| | (_| | || (_| |
+#  \__,_|\__,_|\__\__,_|
+#
+class ROI(object):
+    xs = None
+    ys = None
+    rect_handle = None
+
+    def __init__(self, xs, ys, rect_handle, y_offset, x_ref_pos, cali_info):
+        if(len(xs) != len(ys)):
+            print 'For each ROI, the number of x points must equal to the number of y points'
+            assert False
+        self.xs = xs
+        self.ys = ys
+        self.transformed_xs, self.transformed_ys = self.transform_xy(self.xs, self.ys, y_offset, x_ref_pos,
+                                                                     cali_info)
+        # self.transformed_ys
+        self.rect_handle = rect_handle
+
+    def transform_xy(self, xs, ys, y_offset, x_ref_pos, cali_info):
+      x_s = roundTo4Digits((np.asarray(xs) - x_ref_pos) * cali_info.Xscale)
+      y_s = roundTo4Digits((np.asarray(ys) - y_offset) * cali_info.Yscale)
+      return mergeDuplicateXs(x_s, y_s)
+
+    def get_ROI_len(self):
+        return len(self.xs)
+
+    def get_xs(self):
+      return self.xs
+
+    def get_ys(self):
+      return self.ys
+
+    def get_transformed_xs(self):
+        return self.transformed_xs
+
+    def get_transformed_ys(self):
+        return self.transformed_ys
+
+    def delete(self):
+        if self.rect_handle is not None:
+            self.rect_handle.remove()
+            self.rect_handle = None
+        # xs and ys are views on the row, just let go of them
+        self.xs = None
+        self.ys = None
+
+
+# A class used to manage all input data and perform transformation on it.
+# The GUI subclasses it to put the rows on the canvas
+class AllRows(object):
+    inputXY = None
+    invertedInputXY = None
+    ROIs = None
+    ROIWindow = None  # [x_start_offset, ROI_len] of the marked ROIs
+    sourceFiles = None
+
+    allXmax = 0
+    allXmin = 0
+
+    allYmax = 0
+    allYmin = 0
+    rowDistance = 20
+    distanceFromBottom = 10
+    isInverted = False
+    ROI_ready_to_save = False
+
+    def __init__(self):
+        self.inputXY = []
+        self.invertedInputXY = []
+        self.ROIs = []  # a list of ROI objects
+        self.sourceFiles = []  # the .dat files the rows were read from
+
+    def is_ROI_ready(self):
+      return self.ROI_ready_to_save
+
+    def deleteROIs(self):
+        if self.ROIs is None:
+            return
+
+        for roi in self.ROIs:
+            roi.delete()
+        del self.ROIs[:]
+        self.ROIWindow = None
+
+    # return [xs, ys, y_min, y_max] of the samples of row within [x_start, x_end]
+    # xs and ys are views on the row when its xs are sorted
+    def get_region(self, row, x_start, x_end):
+        return self.get_region_of(row, row.getRange(x_start, x_end))
+
+    # same as get_region, for the samples selected by index
+    def get_region_of(self, row, index):
+        ret_xs = row.xs[index]
+        ret_ys = row.ysAt(index)
+        # the first sample of the row always counts for the height of the region
+        y_min = float(row.ysAt(0))
+        y_max = y_min
+        if len(ret_ys) > 0:
+            y_min = min(y_min, float(ret_ys.min()))
+            y_max = max(y_max, float(ret_ys.max()))
+
+        return ret_xs, ret_ys, y_min, y_max
+
+    # called once with [[x_start, x_end, y_min, y_max]...] of all the ROIs
+    # just extracted. Nothing to show without a canvas
+    def mark_regions(self, regions):
+        pass
+
+    # extracts the window of every sync line from each of the 3 lead rows. The
+    # windows of a row are all looked up with one search
+    def mark_ROI_regions(self, x_start_offset, ROI_len, syncLineXs, hLineYs, cali_info):
+        # marking again replaces the ROIs (and their rectangles) marked before
+        self.deleteROIs()
+        x_y_data = self.getCurrentPlotedXYs()
+        x_y_data = x_y_data[1:]
+        x_y_data = reversed(x_y_data)
+        hLineYs = list(reversed(hLineYs))
+        self.ROIWindow = [x_start_offset, ROI_len]
+        regions = []
+        row_index = 0
+        with profiler.stage('markROIs') as stage:
+            for row in x_y_data:
+                windows = []
+                for syncLineX in syncLineXs:
+                    x_start = syncLineX - x_start_offset
+                    windows.append([x_start, x_start + ROI_len])
+
+                for syncLineX, window, index in zip(syncLineXs, windows, row.getRanges(windows)):
+                    ret_xs, ret_ys, y_min, y_max = self.get_region_of(row, index)
+                    regions.append([window[0], window[1], y_min, y_max])
+                    self.ROIs.append(ROI(ret_xs, ret_ys, None, hLineYs[row_index], syncLineX, cali_info))
+                    stage.samples += len(ret_xs)
+                row_index += 1
+
+        self.mark_regions(regions)
+
+    def save_ROI_regions(self, fd, progress=None):
+        if len(self.ROIs) is 0:
+            print 'ROIs not marked yet'
+            return
+
+        if len(self.ROIs) is not len(save_data_lead_names):
+            print 'The number of ROI is wrong: ', len(self.ROIs)
+            return
+
+        # assume the ROI is arranged in the correct order corresponding to the title header
+        allLeads = []
+        for ROI in self.ROIs:
+            allLeads.append(ROI.get_transformed_xs())
+            allLeads.append(ROI.get_transformed_ys())
+
+        # the file ends with the shortest ROI
+        writeColumnsCSV(fd, getTitleRow(), allLeads, min(len(lead) for lead in allLeads), progress)
+        fd.close()
+
+    def addRow(self, xs, ys):
+
+        with profiler.stage('addRow', len(xs)):
+            row = OneRowXY(xs, ys)
+        self.inputXY.append(row)
+
+    # when this function is called. It means all data are stored in inputXY
+    # This function 1. adjust the saved data
+    # 2. set up the inverted version of the data, which shares the arrays of inputXY
+    def finishLoading(self):
+        with profiler.stage('finishLoading', sum(len(row.xs) for row in self.inputXY)):
+            self.inputXY = self.adjustRows(self.inputXY)
+
+            # find the global maximum Y
+            for eachRow in self.inputXY:
+
+                if self.allXmax < eachRow.xMax:
+                    self.allXmax = eachRow.xMax
+
+                if self.allXmin > eachRow.xMin:
+                    self.allXmin = eachRow.xMin
+
+                if self.allYmax < eachRow.yMax:
+                    self.allYmax = eachRow.yMax
+
+            self.invertedInputXY = [InvertedRowXY(eachRow, self.allYmax) for eachRow in self.inputXY]
+            self.invertedInputXY = self.adjustRows(self.invertedInputXY)
+            # at this point, both invertedInputXY and XY are sorted
+
+    def invert(self):
+        self.isInverted = not self.isInverted
+
+    def getCurrentPlotedXYs(self):
+        if self.isInverted:
+            return self.invertedInputXY
+        else:
+            return self.inputXY
+
+    # adjust the position of these XY rows
+    def adjustRows(self, rows):
+        with profiler.stage('adjustRows', sum(len(row.xs) for row in rows)):
+            rows = sorted(rows)
+            # shift the lowest line
+            shiftUpOffset = self.distanceFromBottom - rows[0].yMin
+            rows[0].shiftY(shiftUpOffset)
+            prevYmax = 0
+            index = 0
+
+            for eachRow in rows:
+                shiftUpOffset = (prevYmax + self.rowDistance) - eachRow.yMin
+                eachRow.shiftY(shiftUpOffset)  # moves the max Y of each row as well
+                prevYmax = eachRow.yMax
+                rows[index] = eachRow
+                index += 1
+
+            return rows
+
+    def reset(self):
+        self.deleteROIs()
+
+        del self.inputXY[:]
+        del self.invertedInputXY[:]
+        del self.sourceFiles[:]
+
+        self.allYmax = 0
+        self.allYmin = 0
+        self.allXmax = 0
+        self.allXmin = 0
+        self.rowDistance = 20
+        self.distanceFromBottom = 10
+        self.isInverted = False
+
+
+# Follows the ROI windows while the ROI is dragged or resized, without
+# extracting them. For each window it keeps the index range and the y extent of
+# its samples. Moving a window only looks at the samples that enter or leave
+# it, and the whole window is scanned again only if its min or max left
+class ROIWindowTracker(object):
+
+    def __init__(self, all_rows, syncLineXs):
+        # same rows in the same order as mark_ROI_regions
+        self.rows = list(reversed(all_rows.getCurrentPlotedXYs()[1:]))
+        self.syncLineXs = list(syncLineXs)
+        self.extents = [None] * (len(self.rows) * len(self.syncLineXs))
+        self.scannedSamples = 0
+
+    # returns [[x_start, x_end, y_min, y_max]...] like mark_regions gets them
+    def moveTo(self, x_start_offset, ROI_len):
+        regions = []
+        windows = []
+        for syncLineX in self.syncLineXs:
+            x_start = syncLineX - x_start_offset
+            windows.append([x_start, x_start + ROI_len])
+
+        extentIndex = 0
+        for row in self.rows:
+            # the first sample of the row always counts for the height of the region
+            firstY = float(row.ysAt(0))
+            for window, index in zip(windows, row.getRanges(windows)):
+                if row.xsSorted:
+                    extent = self.shiftExtent(row, self.extents[extentIndex], index.start, index.stop)
+                else:
+                    extent = [None, None] + self.scanExtent(row, index)
+                self.extents[extentIndex] = extent
+                extentIndex += 1
+
+                y_min = firstY
+                y_max = firstY
+                if extent[2] is not None:
+                    y_min = min(y_min, extent[2])
+                    y_max = max(y_max, extent[3])
+                regions.append([window[0], window[1], y_min, y_max])
+        return regions
+
+    # returns [y_min, y_max] of the samples selected by index, both None if
+    # there are none
+    def scanExtent(self, row, index):
+        ys = row.ysAt(index)
+        self.scannedSamples += len(ys)
+        if len(ys) == 0:
+            return [None, None]
+        return [float(ys.min()), float(ys.max())]
+
+    # extent: [lo, hi, y_min, y_max] of the window before it moved to [lo, hi)
+    def shiftExtent(self, row, extent, lo, hi):
+        if extent is None or extent[2] is None or lo >= extent[1] or hi <= extent[0]:
+            return [lo, hi] + self.scanExtent(row, slice(lo, hi))
+
+        oldLo, oldHi, y_min, y_max = extent
+        leaving = [slice(oldLo, lo), slice(hi, oldHi)]
+        entering = [slice(lo, oldLo), slice(oldHi, hi)]
+        for index in leaving:
+            ys = row.ysAt(index)
+            self.scannedSamples += len(ys)
+            if len(ys) != 0 and (ys.min() <= y_min or ys.max() >= y_max):
+                # an extreme left the window
+                return [lo, hi] + self.scanExtent(row, slice(lo, hi))
+
+        for index in entering:
+            ys = row.ysAt(index)
+            self.scannedSamples += len(ys)
+            if len(ys) != 0:
+                y_min = min(y_min, float(ys.min()))
+                y_max = max(y_max, float(ys.max()))
+        return [lo, hi, y_min, y_max]
+
+
+# returns what selects the samples with x_start <= x <= x_end (x < x_end if
+# include_end is False): a slice if xs is sorted, otherwise an array of indexes
+def getIndexRange(xs, x_start, x_end, is_sorted, include_end=True):
+    if is_sorted:
+        lo = np.searchsorted(xs, x_start, 'left')
+        hi = np.searchsorted(xs, x_end, 'right' if include_end else 'left')
+        return slice(lo, max(lo, hi))
+
+    if include_end:
+        return np.flatnonzero((x_start <= xs) & (xs <= x_end))
+    return np.flatnonzero((x_start <= xs) & (xs < x_end))
+
+
+# Level of detail for plotting. Level 0 keeps the index of the min and the max
+# y of every LOD_BASE_BUCKET samples, each next level does the same over
+# LOD_LEVEL_FACTOR buckets of the level below. Only indexes are kept, so the
+# pyramid of a row also serves its inverted view (flipping and shifting swap
+# the min and the max of a bucket, but they are still the same two samples)
+LOD_BASE_BUCKET = 16
+LOD_LEVEL_FACTOR = 4
+LOD_MIN_BUCKETS = 256
+
+
+# keeps the indexes of the min and the max y in every group of indexes,
+# in increasing order so the plotted line still runs from left to right
+def bucketMinMax(ys, indexes, group):
+    padding = -len(indexes) % group
+    if padding:
+        indexes = np.concatenate((indexes, np.repeat(indexes[-1:], padding)))
+    candidates = indexes.reshape(-1, group)
+    values = ys[candidates]
+    rows = np.arange(len(candidates))
+    lo = candidates[rows, values.argmin(axis=1)]
+    hi = candidates[rows, values.argmax(axis=1)]
+    kept = np.empty((len(candidates), 2), dtype=np.intp)
+    kept[:, 0] = np.minimum(lo, hi)
+    kept[:, 1] = np.maximum(lo, hi)
+    return kept.ravel()
+
+
+# returns [[bucket size, indexes]...] from the finest level to the coarsest one
+def buildLODLevels(ys):
+    levels = []
+    if len(ys) < LOD_BASE_BUCKET * LOD_MIN_BUCKETS:
+        return levels
+
+    bucket = LOD_BASE_BUCKET
+    indexes = bucketMinMax(ys, np.arange(len(ys)), bucket)
+    while True:
+        levels.append([bucket, indexes])
+        if len(indexes) < 2 * LOD_LEVEL_FACTOR * LOD_MIN_BUCKETS:
+            break
+        bucket *= LOD_LEVEL_FACTOR
+        indexes = bucketMinMax(ys, indexes, 2 * LOD_LEVEL_FACTOR)
+    return levels
+
+
+# One row of samples. xs and ys are float64 arrays, the statistics are computed
+# once and then kept up to date by shiftY
+class OneRowXY(object):
+    __slots__ = ('xs', 'ys', 'yMin', 'yMax', 'yAve', 'xMin', 'xMax', 'xsSorted', 'lodLevels')
+
+    def __init__(self, xs=None, ys=None):
+        if ys is None:
+            ys = []
+        if xs is None:
+            xs = []
+
+        if len(xs) != len(ys):
+            print 'This is weird. A row should have equal number of Xs and Ys'
+            assert False
+
+        self.xs = np.asarray(xs, dtype=np.float64)
+        self.ys = np.asarray(ys, dtype=np.float64)
+        self.xsSorted = bool(np.all(self.xs[1:] >= self.xs[:-1]))
+        self.lodLevels = None
+        self.resetMaxMinAverage()
+
+    def resetMaxMinAverage(self):
+        self.yAve = float(self.ys.mean())
+        self.yMin = float(self.ys.min())
+        self.yMax = float(self.ys.max())
+        self.xMin = float(self.xs.min())
+        self.xMax = float(self.xs.max())
+
+    # move the whole row up by offset. Adding the same offset to every y keeps
+    # their order, so min and max move exactly with it and need no rescan
+    def shiftY(self, offset):
+        self.ys = self.ys + offset
+        self.yMin += offset
+        self.yMax += offset
+        self.yAve += offset
+
+    def ysAt(self, index):
+        return self.ys[index]
+
+    def getRange(self, x_start, x_end, include_end=True):
+        return getIndexRange(self.xs, x_start, x_end, self.xsSorted, include_end)
+
+    # getRange for each [x_start, x_end] of windows, searching for all of them at once
+    def getRanges(self, windows):
+        if not self.xsSorted:
+            return [self.getRange(x_start, x_end) for x_start, x_end in windows]
+        starts = np.searchsorted(self.xs, [window[0] for window in windows], 'left')
+        ends = np.searchsorted(self.xs, [window[1] for window in windows], 'right')
+        return [slice(lo, max(lo, hi)) for lo, hi in zip(starts, ends)]
+
+    # index of the first sample with x >= x_start, or len(xs) if there is none
+    def getFirstIndex(self, x_start):
+        if self.xsSorted:
+            return int(np.searchsorted(self.xs, x_start, 'left'))
+        atOrAfter = self.xs >= x_start
+        if not atOrAfter.any():
+            return len(self.xs)
+        return int(np.argmax(atOrAfter))
+
+    # shiftY keeps the order of the ys, so the pyramid is built only once
+    def getLODLevels(self):
+        if self.lodLevels is None:
+            self.lodLevels = buildLODLevels(self.ys)
+        return self.lodLevels
+
+    # returns what selects the samples to plot for x_start <= x <= x_end on an
+    # axis max_buckets pixels wide: the coarsest level whose buckets are no
+    # wider than a pixel, so every peak still shows up exactly. Unsorted rows
+    # are always plotted in full
+    def getLODRange(self, x_start, x_end, max_buckets):
+        if not self.xsSorted:
+            return slice(None)
+
+        # one sample past each end, so the line runs to the edge of the view
+        lo = max(int(np.searchsorted(self.xs, x_start, 'left')) - 1, 0)
+        hi = min(int(np.searchsorted(self.xs, x_end, 'right')) + 1, len(self.xs))
+        samplesPerBucket = (hi - lo) / float(max(max_buckets, 1))
+
+        chosen = None
+        for bucket, indexes in self.getLODLevels():
+            if bucket > samplesPerBucket:
+                break
+            chosen = indexes
+        if chosen is None:
+            return slice(lo, hi)
+
+        first = np.searchsorted(chosen, lo, 'left')
+        last = np.searchsorted(chosen, hi, 'left')
+        return np.concatenate(([lo], chosen[first:last], [hi - 1]))
+
+    # implement the comparing interface
+    def __lt__(self, other):
+        return self.yAve < other.yAve
+
+    def __gt__(self, other):
+        return self.yAve > other.yAve
+
+    def __eq__(self, other):
+        return self.yAve == other.yAve
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+# The upside-down view of a row: ys = yTop - source.ys, then shifted by each of
+# yOffsets. Only the offsets are stored, the ys are worked out from the arrays
+# of the source row whenever they are asked for
+class InvertedRowXY(OneRowXY):
+    __slots__ = ('source', 'yTop', 'yOffsets')
+
+    def __init__(self, source, y_top):
+        self.source = source
+        self.yTop = y_top
+        self.yOffsets = ()
+        self.xs = source.xs
+        self.xsSorted = source.xsSorted
+        self.lodLevels = None
+        self.xMin = source.xMin
+        self.xMax = source.xMax
+        # flipping turns the max into the min and the other way round
+        self.yMin = y_top - source.yMax
+        self.yMax = y_top - source.yMin
+        self.yAve = y_top - source.yAve
+
+    @property
+    def ys(self):
+        ys = self.yTop - self.source.ys
+        for offset in self.yOffsets:
+            ys += offset
+        return ys
+
+    def getLODLevels(self):
+        return self.source.getLODLevels()
+
+    # only works out the ys that are asked for
+    def ysAt(self, index):
+        ys = self.yTop - self.source.ys[index]
+        for offset in self.yOffsets:
+            ys += offset
+        return ys
+
+    def resetMaxMinAverage(self):
+        ys = self.ys
+        self.yAve = float(ys.mean())
+        self.yMin = float(ys.min())
+        self.yMax = float(ys.max())
+
+    def shiftY(self, offset):
+        self.yOffsets += (offset,)
+        self.yMin += offset
+        self.yMax += offset
+        self.yAve += offset
+
+
+class CaliInfo(object):
+    caliFactor1 = None
+    caliFactor2 = None
+
+    deltaX = None
+    deltaY = None
+
+    handle = None
+    Yscale = None
+    Xscale = None
+
+    def __init__(self):
+        self.resetAll()
+
+    def setXY(self, info):
+        self.deltaX = info[0]
+        self.deltaY = info[1]
+
+    def setCaliFactor(self, factors):
+        self.voltageCalibrationFactor = factors[0]
+        self.timeCalibrationFactor = factors[1]
+
+        self.Yscale = float(self.voltageCalibrationFactor) / self.deltaY
+        self.Xscale = float(self.timeCalibrationFactor) / self.deltaX
+
+    def getCaliInfor(self):
+        if self.handle is None:
+            return None
+
+        return [self.caliFactor1, self.caliFactor2, self.leftTopX, self.leftTopY, self.rightBottomX, self.rightBottomY]
+
+    def setHandle(self, handle):
+        self.handle = handle
+
+    def caliInfoReady(self):
+        return self.handle is not None
+
+    def resetAll(self):
+        self.leftTopX = None
+        self.leftTopY = None
+        self.rightBottomX = None
+        self.rightBottomY = None
+        self.caliFactor1 = None
+        self.caliFactor2 = None
+
+
+#            _ _ _
+#  ___ _ __ | (_) |_
+# / __| '_ \| | | __|
+# \__ \ |_) | | | |_
+# |___/ .__/|_|_|\__|
+#     |_|
+#
+CSV_CHUNK_ROWS = 4096
+
+
+def getTitleRow():
+    titleRow = []
+    for leadName in save_data_lead_names:
+        titleRow.append(leadName + ' (X)')
+        titleRow.append(leadName + ' (Y)')
+    return titleRow
+
+
+# write the title and then row_num rows made of the given column arrays, a chunk
+# of rows at a time, so nothing as big as the whole table is ever built.
+# Columns shorter than row_num end in empty cells. row_num must not be more
+# than the length of the longest column
+def writeColumnsCSV(fd, title_row, columns, row_num, progress=None):
+    csv.register_dialect('excel_custom', 'excel', lineterminator='\n')
+    writer = csv.writer(fd, 'excel_custom')
+    writer.writerow(title_row)
+
+    # samples are the cells written
+    with profiler.stage('writeCSV', row_num * len(columns)):
+        for chunkStart in range(0, row_num, CSV_CHUNK_ROWS):
+            chunkEnd = min(chunkStart + CSV_CHUNK_ROWS, row_num)
+            # tolist() hands the csv module plain floats, which it formats in C
+            chunk = [column[chunkStart:chunkEnd].tolist() for column in columns]
+            writer.writerows(itertools.izip_longest(*chunk, fillvalue=""))
+            reportProgress(progress, chunkEnd, row_num)
+
+
+# split the rows into leads. Returns one list of leads per row, in the order
+# of save_data_lead_names
+def splitAllRows(all_rows, vLineXs, syncLineXs, hLineYs, cali_info):
+    allXyRows = all_rows.getCurrentPlotedXYs()
+    # only needs the first 3 rows (the last row is reference)
+    # assume rows are sorted already
+
+    allXyRows = allXyRows[1:]
+    allXyRows = reversed(allXyRows)
+
+    allRowLeads = []
+    hLineYs = list(reversed(hLineYs))
+    allXyRowsIndex = 0
+    for eachRow in allXyRows:
+        yOffset = hLineYs[allXyRowsIndex]
+        allXyRowsIndex += 1
+        with profiler.stage('splitOneRow', len(eachRow.xs)):
+            allRowLeads.append(splitOneRow(eachRow, vLineXs, syncLineXs, yOffset, cali_info))
+    return allRowLeads
+
+
+def preSaveDataProcess(fd, vLineXs, syncLineXs, hLineYs, all_rows, cali_info, progress=None):
+    allLeads = []
+    rowLens = []
+    for leads in splitAllRows(all_rows, vLineXs, syncLineXs, hLineYs, cali_info):
+        for lead in leads:
+            allLeads.append(lead.xs)
+            allLeads.append(lead.ys)
+        rowLens.append(max(len(lead.xs) for lead in leads))
+
+    # shorter leads are padded with empty cells up to the longest lead of their
+    # row, and the file ends with the shortest of those rows
+    writeColumnsCSV(fd, getTitleRow(), allLeads, min(rowLens), progress)
+    fd.close()
+
+
+# 10 ** k is exact as a double for 0 <= k <= 22
+EXACT_POWERS_OF_TEN = 10.0 ** np.arange(23)
+
+
+# round every value to 4 significant figures. Gives exactly what
+# float("{0:.4g}".format(x)) gives, without a string round trip per value
+def roundTo4Digits(values):
+    values = np.asarray(values, dtype=np.float64)
+    flatValues = values.ravel()
+    rounded = np.empty_like(flatValues)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        absValues = np.abs(flatValues)
+        fast = np.isfinite(flatValues) & (absValues > 0)
+        shifts = 3 - np.floor(np.log10(np.where(fast, absValues, 1.0))).astype(np.int64)
+        fast &= np.abs(shifts) <= 22
+
+        # bring the 4 significant digits in front of the decimal point. Multiplying or
+        # dividing by an exact power of ten rounds once, just like parsing the digits
+        up = fast & (shifts >= 0)
+        down = fast & (shifts < 0)
+        scaled = np.zeros_like(flatValues)
+        scaled[up] = flatValues[up] * EXACT_POWERS_OF_TEN[shifts[up]]
+        scaled[down] = flatValues[down] / EXACT_POWERS_OF_TEN[-shifts[down]]
+
+        # leave to the string round trip: a wrong guess of the exponent (right next
+        # to a power of ten) and values too close to halfway between two roundings
+        absScaled = np.abs(scaled)
+        tolerance = 1e-9 * absScaled
+        fast &= (absScaled >= 1000 + tolerance) & (absScaled < 10000 - tolerance)
+        fast &= np.abs(absScaled - np.floor(absScaled) - 0.5) > tolerance
+
+    digits = np.rint(scaled)
+    up &= fast
+    down &= fast
+    rounded[up] = digits[up] / EXACT_POWERS_OF_TEN[shifts[up]]
+    rounded[down] = digits[down] * EXACT_POWERS_OF_TEN[-shifts[down]]
+
+    # zeros, inf, nan, extreme exponents and the cases above
+    slow = np.flatnonzero(~fast)
+    rounded[slow] = [float("{0:.4g}".format(x)) for x in flatValues[slow].tolist()]
+    return rounded.reshape(values.shape)
+
+
+# samples that end up with the same x are merged into one. Their ys are
+# averaged one after another in the order of the samples, rounding each step
+def mergeDuplicateXs(xs, ys):
+    if len(xs) == 0:
+        return xs, ys
+
+    newRun = np.empty(len(xs), dtype=bool)
+    newRun[0] = True
+    newRun[1:] = xs[1:] != xs[:-1]
+    runStarts = np.flatnonzero(newRun)
+    runLens = np.diff(np.append(runStarts, len(xs)))
+
+    uniqueXs = xs[runStarts]
+    uniqueYs = ys[runStarts]
+    # the k-th sample of every run that is long enough goes in at the same time
+    for k in range(1, int(runLens.max())):
+        inRun = runLens > k
+        uniqueYs[inRun] = roundTo4Digits((ys[runStarts[inRun] + k] + uniqueYs[inRun]) / 2)
+
+    return uniqueXs, uniqueYs
+
+
+'''
+Split a row of Xs and Ys according to the Xs of the vertical lines
+'''
+
+
+def splitOneRow(row, vLineXs, syncLineXs, yOffset, cali_info):
+
+    # Truncate data before first vLine
+    truncateIndex = row.getFirstIndex(vLineXs[0])
+    rowXs = row.xs[truncateIndex:]
+    rowYs = row.ysAt(slice(truncateIndex, None))
+    vLineXs = vLineXs[1:]  # get rid of first vLine to not disturb rest of function
+
+    xScale = cali_info.Xscale
+    yScale = cali_info.Yscale
+
+    verticalLineWidthPercent = 0.02
+    xMin = float(rowXs.min())
+    deltaX = float(rowXs.max()) - xMin
+    verticalLineWidth = verticalLineWidthPercent * deltaX
+
+    # each lead takes the samples in [start, end). It starts a little after the
+    # previous vertical line and ends a little before the next one
+    leadStarts = []
+    leadEnds = []
+    for vLineX in vLineXs:
+        vLineX -= verticalLineWidth
+        leadStarts.append(xMin)
+        leadEnds.append(vLineX)
+        xMin = vLineX + verticalLineWidth * 2
+
+    # one search over the row finds the samples of every lead
+    if row.xsSorted:
+        bounds = np.searchsorted(rowXs, leadStarts + leadEnds, 'left')
+        leadNum = len(leadStarts)
+        leadIndexes = [slice(lo, max(lo, hi)) for lo, hi in zip(bounds[:leadNum], bounds[leadNum:])]
+    else:
+        leadIndexes = [getIndexRange(rowXs, start, end, False, include_end=False)
+                       for start, end in zip(leadStarts, leadEnds)]
+
+    leads = []  # A list of OneRowXY objects
+    for index, xOffset in zip(leadIndexes, syncLineXs):
+        xs = roundTo4Digits((rowXs[index] - xOffset) * xScale)
+        ys = roundTo4Digits((rowYs[index] - yOffset) * yScale)
+        xs, ys = mergeDuplicateXs(xs, ys)
+        leads.append(OneRowXY(xs, ys))
+
+    # the leads have different lengths, the writer pads them
+    return leads
+
+
+#                                      _
+#  _ __ ___  ___  __ _ _ __ ___  _ __ | | ___
+# | '__/ _ \/ __|/ _` | '_ ` _ \| '_ \| |/ _ \
+# | | |  __/\__ \ (_| | | | | | | |_) | |  __/
+# |_|  \___||___/\__,_|_| |_| |_| .__/|_|\___|
+#                               |_|
+#
+# Puts the calibrated leads (or ROIs) on one time grid, so they become a dense
+# (12, T) array instead of 12 lists of different lengths with uneven spacing.
+# The grid has sample_rate points per second and runs through t = 0 (the sync
+# line). Each lead is linearly interpolated between its samples and is NaN
+# where it has none
+GRID_TIME_TITLE = 'Time (s)'
+
+
+# leads: [[xs, ys]...]. Returns [times, values] where values[i] is leads[i] at times
+def resampleLeads(leads, sample_rate):
+    if sample_rate <= 0:
+        raise ValueError('The sample rate must be positive')
+
+    leads = [[np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)] for xs, ys in leads]
+    nonEmpty = [xs for xs, ys in leads if len(xs) != 0]
+    if len(nonEmpty) == 0:
+        return np.empty(0), np.empty((len(leads), 0))
+
+    # whole multiples of the sample period, the small slack keeps times that are
+    # only off by rounding on the grid
+    first = int(np.ceil(min(xs.min() for xs in nonEmpty) * sample_rate - 1e-6))
+    last = int(np.floor(max(xs.max() for xs in nonEmpty) * sample_rate + 1e-6))
+    times = np.arange(first, last + 1) / float(sample_rate)
+
+    values = np.full((len(leads), len(times)), np.nan)
+    with profiler.stage('resample', values.size):
+        for leadValues, (xs, ys) in zip(values, leads):
+            if len(xs) == 0:
+                continue
+            if np.any(xs[1:] < xs[:-1]):
+                order = np.argsort(xs, kind='mergesort')
+                xs = xs[order]
+                ys = ys[order]
+            inside = (times >= xs[0]) & (times <= xs[-1])
+            leadValues[inside] = np.interp(times[inside], xs, ys)
+    return times, values
+
+
+def getLeadGrid(vLineXs, syncLineXs, hLineYs, all_rows, cali_info, sample_rate):
+    allLeads = [[lead.xs, lead.ys] for leads in splitAllRows(all_rows, vLineXs, syncLineXs, hLineYs, cali_info)
+                for lead in leads]
+    return resampleLeads(allLeads, sample_rate)
+
+
+def getROIGrid(all_rows, sample_rate):
+    return resampleLeads([[roi.get_transformed_xs(), roi.get_transformed_ys()] for roi in all_rows.ROIs],
+                         sample_rate)
+
+
+# one row per point of the grid: the time, then the 12 leads. NaN is written as nan
+def writeGridCSV(fd, times, values, progress=None):
+    writeColumnsCSV(fd, [GRID_TIME_TITLE] + save_data_lead_names, [times] + list(values), len(times), progress)
+    fd.close()
+
+
+#                             _
+#   _____  ___ __   ___  _ __| |_
+#  / _ \ \/ / '_ \ / _ \| '__| __|
+# |  __/>  <| |_) | (_) | |  | |_
+#  \___/_/\_\ .__/ \___/|_|   \__|
+#           |_|
+#
+EXPORT_FORMAT = 'ecg-analyzer-export'
+EXPORT_VERSION = 1
+
+
+def hashFile(file_name):
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+# write the calibrated leads, the ROIs (if they are marked) and everything needed
+# to make sense of them to one compressed .npz file. Lead "I" is stored as the
+# arrays lead_I_x and lead_I_y, its ROI as roi_I_x and roi_I_y. The rest goes
+# as JSON into the "meta" entry
+# with a sample_rate the leads and ROIs also go in on a time grid, as grid_t,
+# grid_leads, grid_roi_t and grid_roi. See resampleLeads
+def exportNPZ(file_name, vLineXs, syncLineXs, hLineYs, all_rows, cali_info, progress=None, sample_rate=None):
+    reportProgress(progress, 0, 2)
+    arrays = {}
+    allLeads = [lead for leads in splitAllRows(all_rows, vLineXs, syncLineXs, hLineYs, cali_info)
+                for lead in leads]
+    for leadName, lead in zip(save_data_lead_names, allLeads):
+        arrays['lead_' + leadName + '_x'] = lead.xs
+        arrays['lead_' + leadName + '_y'] = lead.ys
+
+    hasROIs = len(all_rows.ROIs) == len(save_data_lead_names)
+    if hasROIs:
+        for leadName, roi in zip(save_data_lead_names, all_rows.ROIs):
+            arrays['roi_' + leadName + '_x'] = roi.get_transformed_xs()
+            arrays['roi_' + leadName + '_y'] = roi.get_transformed_ys()
+
+    if sample_rate is not None:
+        arrays['grid_t'], arrays['grid_leads'] = resampleLeads([[lead.xs, lead.ys] for lead in allLeads],
+                                                               sample_rate)
+        if hasROIs:
+            arrays['grid_roi_t'], arrays['grid_roi'] = getROIGrid(all_rows, sample_rate)
+
+    meta = {
+        'format': EXPORT_FORMAT,
+        'version': EXPORT_VERSION,
+        'leadNames': save_data_lead_names,
+        'calibration': {
+            'Xscale': cali_info.Xscale,
+            'Yscale': cali_info.Yscale,
+            'deltaX': cali_info.deltaX,
+            'deltaY': cali_info.deltaY,
+            'voltage': float(cali_info.voltageCalibrationFactor),
+            'time': float(cali_info.timeCalibrationFactor),
+        },
+        'inverted': all_rows.isInverted,
+        'vLines': list(vLineXs),
+        'syncLines': list(syncLineXs),
+        'hLines': list(hLineYs),
+        'roiWindow': all_rows.ROIWindow,
+        'sampleRate': sample_rate,
+        'sources': [{'file': os.path.basename(fn), 'size': os.path.getsize(fn), 'sha1': hashFile(fn)}
+                    for fn in all_rows.sourceFiles],
+    }
+    arrays['meta'] = np.array(json.dumps(meta, sort_keys=True).decode('utf-8'))
+    reportProgress(progress, 1, 2)
+    with profiler.stage('writeNPZ', sum(array.size for array in arrays.values())):
+        np.savez_compressed(file_name, **arrays)
+    reportProgress(progress, 2, 2)
+
+
+# read back a file written by exportNPZ. Returns [leads, ROIs, meta] where leads
+# and ROIs map a lead name to its [xs, ys]. ROIs is empty if none were exported
+def readExportNPZ(file_name):
+    data = np.load(file_name)
+    try:
+        meta = json.loads(data['meta'].item())
+        leads = {}
+        ROIs = {}
+        for leadName in meta['leadNames']:
+            leads[leadName] = [data['lead_' + leadName + '_x'], data['lead_' + leadName + '_y']]
+            if 'roi_' + leadName + '_x' in data.files:
+                ROIs[leadName] = [data['roi_' + leadName + '_x'], data['roi_' + leadName + '_y']]
+    finally:
+        data.close()
+    return leads, ROIs, meta
+
+
+# read back the time grids of a file written by exportNPZ with a sample rate.
+# Returns [times, leads, ROI times, ROIs], the ROI ones are None if no ROIs
+# were exported
+def readExportGrid(file_name):
+    data = np.load(file_name)
+    try:
+        if 'grid_leads' not in data.files:
+            raise ValueError(file_name + ' was exported without a sample rate')
+        grid = [data['grid_t'], data['grid_leads'], None, None]
+        if 'grid_roi' in data.files:
+            grid[2] = data['grid_roi_t']
+            grid[3] = data['grid_roi']
+    finally:
+        data.close()
+    return grid
+
+
+#             _ _     _       _
+# __   ____ _| (_) __| | __ _| |_ ___
+# \ \ / / _` | | |/ _` |/ _` | __/ _ \
+#  \ V / (_| | | | (_| | (_| | ||  __/
+#   \_/ \__,_|_|_|\__,_|\__,_|\__\___|
+#
+# returns an error message if the marker lines are not usable, None otherwise
+def checkLines(vLineXs, syncLineXs):
+    if len(vLineXs) != len(syncLineXs) + 1:
+        return 'Invalid synchronization lines. Should have one less than vertical lines'
+
+    for i in range(len(syncLineXs)):
+        if syncLineXs[i] < vLineXs[i] or syncLineXs[i] > vLineXs[i + 1]:
+            return 'Invalid synchronization lines. Each sync line should be between two vertical lines'
+
+    return None
+
+
+# transform an ROI marked at [x_min, x_max] to [x_start_offset, ROI_len]
+# returns None if the ROI is not inside one of the regions it is allowed to be in
+# or the lines are not complete
+def findROIWindow(vLineXs, syncLineXs, x_min, x_max):
+    if len(vLineXs) != len(syncLineXs) + 1:
+        return None
+
+    # find regions that ROI is allowed to be in
+    regions = list()
+    for i in range(len(syncLineXs)):
+        region = list()
+        region.append(vLineXs[i])  # blue vertical line
+        region.append(syncLineXs[i])  # green vertical (sync) line
+        region.append(vLineXs[i+1])
+        regions.append(region)
+
+    # check which region is the marked ROI in
+    sync_line_x_pos = None
+    for region in regions:
+        # found it to the left of the vertical sync line
+        if (region[0] <= x_min) and (x_max <= region[1]):
+            sync_line_x_pos = region[1]
+            break
+
+        # found it to the right of the vertical sync line
+        if (region[1] <= x_min) and (x_max <= region[2]):
+            sync_line_x_pos = region[1]
+            break
+
+    if sync_line_x_pos is None:
+        return None
+
+    ROI_len = x_max - x_min
+    x_start_offset = sync_line_x_pos - x_min  # how much to the left of the sync line it is
+    return [x_start_offset, ROI_len]
+
+
+# the other way round: [x_min, x_max] of the window [x_start_offset, ROI_len]
+# around the first sync line it is allowed at, None if there is none
+def getROIRange(vLineXs, syncLineXs, window):
+    if len(vLineXs) != len(syncLineXs) + 1:
+        return None
+
+    x_start_offset, ROI_len = window
+    for syncLineX in syncLineXs:
+        x_min = syncLineX - x_start_offset
+        x_max = x_min + ROI_len
+        if findROIWindow(vLineXs, syncLineXs, x_min, x_max) is not None:
+            return [x_min, x_max]
+    return None
+
+
+#                          _        _   _
+#   __ _ _ __  _ __   ___ | |_ __ _| |_(_) ___  _ __
+#  / _` | '_ \| '_ \ / _ \| __/ _` | __| |/ _ \| '_ \
+# | (_| | | | | | | | (_) | || (_| | |_| | (_) | | | |
+#  \__,_|_| |_|_| |_|\___/ \__\__,_|\__|_|\___/|_| |_|
+#
+# An annotation file is a JSON object holding everything the operator marks in
+# the GUI. All positions are in plot coordinates of the (inverted) layout:
+# {
+#     "calibration": {"deltaX": 25.0, "deltaY": 40.0, "voltage": 1, "time": 0.2},
+#     "inverted": false,
+#     "vLines": [5 x positions],
+#     "syncLines": [4 x positions],
+#     "hLines": [3 y positions],
+#     "roi": [x_min, x_max]              (optional)
+# }
+# The GUI saves its session in the same format, also half way through marking:
+# then the calibration is null and the lists are shorter. It adds the corner
+# "x" and "y" of the calibration box so the box can be drawn again
+
+# reads an annotation that may be incomplete, like a saved GUI session
+def readAnnotation(file_name):
+    with open(file_name) as fp:
+        annotation = json.load(fp)
+
+    calibration = annotation.setdefault('calibration', None)
+    if calibration is not None:
+        for key in ['deltaX', 'deltaY', 'voltage', 'time']:
+            if key not in calibration:
+                raise ValueError('annotation file ' + file_name + ' has no calibration "' + key + '"')
+
+    for key, maxNum in [('vLines', VerticalLineNum), ('syncLines', VerticalLineNum - 1),
+                        ('hLines', HorizontalLineNum)]:
+        if len(annotation.setdefault(key, [])) > maxNum:
+            raise ValueError('annotation file ' + file_name + ' has more than ' + str(maxNum) + ' "' + key + '"')
+
+    annotation.setdefault('inverted', False)
+    annotation.setdefault('roi', None)
+    return annotation
+
+
+# reads an annotation that has everything processStudy needs
+def loadAnnotation(file_name):
+    annotation = readAnnotation(file_name)
+    if annotation['calibration'] is None:
+        raise ValueError('annotation file ' + file_name + ' has no "calibration"')
+
+    if len(annotation['vLines']) != VerticalLineNum:
+        raise ValueError('need exactly ' + str(VerticalLineNum) + ' vertical lines')
+    if len(annotation['syncLines']) != VerticalLineNum - 1:
+        raise ValueError('need exactly ' + str(VerticalLineNum - 1) + ' sync lines')
+    if len(annotation['hLines']) != HorizontalLineNum:
+        raise ValueError('need exactly ' + str(HorizontalLineNum) + ' horizontal lines')
+    return annotation
+
+
+# the annotation of what is marked so far. Without cali_info (or its factors)
+# the calibration is left out
+def makeAnnotation(cali_info, vLineXs, syncLineXs, hLineYs, inverted=False, roi=None):
+    calibration = None
+    if cali_info is not None and cali_info.Yscale is not None:
+        calibration = {
+            'deltaX': cali_info.deltaX,
+            'deltaY': cali_info.deltaY,
+            'voltage': float(cali_info.voltageCalibrationFactor),
+            'time': float(cali_info.timeCalibrationFactor),
+        }
+    return {
+        'calibration': calibration,
+        'inverted': inverted,
+        'vLines': sorted(vLineXs),
+        'syncLines': sorted(syncLineXs),
+        'hLines': sorted(hLineYs),
+        'roi': roi,
+    }
+
+
+def writeAnnotation(file_name, annotation):
+    with open(file_name, 'w') as fp:
+        json.dump(annotation, fp, sort_keys=True)
+        fp.write('\n')
+
+
+def getCaliInfo(annotation):
+    calibration = annotation['calibration']
+    cali_info = CaliInfo()
+    cali_info.setXY([calibration['deltaX'], calibration['deltaY']])
+    cali_info.setCaliFactor([calibration['voltage'], calibration['time']])
+    return cali_info
+
+
+def loadStudy(dir_name):
+    allInputFiles = getDatFiles(dir_name)
+    if len(allInputFiles) != DAT_FILE_NUM:
+        raise ValueError('Need exactly ' + str(DAT_FILE_NUM) + ' dat files in ' + dir_name)
+
+    all_rows = AllRows()
+    for xs, ys in readAllDatFiles(allInputFiles):
+        all_rows.addRow(xs, ys)
+    all_rows.sourceFiles = allInputFiles
+    all_rows.finishLoading()
+    return all_rows
+
+
+# run the whole load/split/save pipeline of one study without the GUI
+# roi_file is only written if the annotation has an ROI
+# with a sample_rate the CSVs hold the leads and ROIs on a time grid, see resampleLeads
+def processStudy(dir_name, annotation, leads_file, roi_file=None, npz_file=None, sample_rate=None):
+    all_rows = loadStudy(dir_name)
+    if annotation['inverted']:
+        all_rows.invert()
+
+    cali_info = getCaliInfo(annotation)
+    vLineXs = sorted(annotation['vLines'])
+    syncLineXs = sorted(annotation['syncLines'])
+    hLineYs = sorted(annotation['hLines'])
+
+    msg = checkLines(vLineXs, syncLineXs)
+    if msg is not None:
+        raise ValueError(msg)
+
+    if leads_file is not None:
+        with open(leads_file, 'w') as fd:
+            if sample_rate is None:
+                preSaveDataProcess(fd, vLineXs, syncLineXs, hLineYs, all_rows, cali_info)
+            else:
+                times, values = getLeadGrid(vLineXs, syncLineXs, hLineYs, all_rows, cali_info, sample_rate)
+                writeGridCSV(fd, times, values)
+
+    if annotation['roi'] is not None and (roi_file is not None or npz_file is not None):
+        x_min = min(annotation['roi'])
+        x_max = max(annotation['roi'])
+        window = findROIWindow(vLineXs, syncLineXs, x_min, x_max)
+        if x_min >= x_max or window is None:
+            raise ValueError('Invalid ROI')
+
+        all_rows.mark_ROI_regions(window[0], window[1], syncLineXs, hLineYs, cali_info)
+        all_rows.ROI_ready_to_save = True
+        if roi_file is not None:
+            with open(roi_file, 'w') as fd:
+                if sample_rate is None:
+                    all_rows.save_ROI_regions(fd)
+                else:
+                    times, values = getROIGrid(all_rows, sample_rate)
+                    writeGridCSV(fd, times, values)
+
+    if npz_file is not None:
+        exportNPZ(npz_file, vLineXs, syncLineXs, hLineYs, all_rows, cali_info, sample_rate=sample_rate)
+    return all_rows
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Split an ECG study into leads without the GUI')
+    parser.add_argument('study_dir', help='folder with the ' + str(DAT_FILE_NUM) + ' .dat files')
+    parser.add_argument('annotation', nargs='?', default=None,
+                        help='annotation file (default: <study_dir>/' + ANNOTATION_FILE_NAME + ')')
+    parser.add_argument('--leads', default=None, help='lead CSV (default: <study_dir>/' + LEADS_FILE_NAME + ')')
+    parser.add_argument('--roi', default=None, help='ROI CSV (default: <study_dir>/' + ROI_FILE_NAME + ')')
+    parser.add_argument('--npz', default=None, help='also export leads, ROIs and metadata to this .npz file')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='resample the leads and ROIs to this many samples per second')
+    parser.add_argument('--profile', default=None,
+                        help='record the time, samples and memory of each stage to this JSON file (also on with '
+                             + PROFILE_ENV + '=1, then written next to the lead CSV as ' + PROFILE_FILE_NAME + ')')
+    parser.add_argument('--cprofile', default=None, help='run under cProfile and save the statistics to this file')
+    args = parser.parse_args(argv)
+
+    annotationFile = args.annotation or os.path.join(args.study_dir, ANNOTATION_FILE_NAME)
+    leadsFile = args.leads or os.path.join(args.study_dir, LEADS_FILE_NAME)
+    roiFile = args.roi or os.path.join(args.study_dir, ROI_FILE_NAME)
+    profileFile = args.profile
+    if profileFile is not None:
+        profiler.enabled = True
+    elif profiler.enabled:
+        profileFile = os.path.join(os.path.dirname(os.path.abspath(leadsFile)), PROFILE_FILE_NAME)
+    profiler.reset()
+
+    ret = EXIT_SUCCESS
+    try:
+        annotation = loadAnnotation(annotationFile)
+        if args.cprofile is not None:
+            runWithCProfile(args.cprofile, processStudy, args.study_dir, annotation, leadsFile, roiFile, args.npz,
+                            args.rate)
+        else:
+            processStudy(args.study_dir, annotation, leadsFile, roiFile, args.npz, args.rate)
+    except (IOError, OSError, ValueError) as e:
+        print >> sys.stderr, 'Error!', e
+        ret = EXIT_FAILURE
+
+    # the profile of a failed run is written as well
+    if profileFile is not None:
+        try:
+            profiler.writeReport(profileFile, {'study': args.study_dir, 'failed': ret != EXIT_SUCCESS})
+        except IOError as e:
+            print >> sys.stderr, 'Error! Cannot write the profile:', e
+            ret = EXIT_FAILURE
+
+    return ret
+
+
+if __name__ == "__main__":
+    sys.exit(main())
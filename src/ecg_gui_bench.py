@@ -0,0 +1,263 @@
+'''
+Replays the marking of a study on the real GUI and times every step, from the
+mouse event until the canvas is drawn again:
+
+python ecg_gui_bench.py [<study dir>] [--samples 100000] [--script script.json] [--record script.json] [--out latency.json]
+
+Without a study a synthetic one is generated (see ecg_bench.py). The default
+script marks the calibration box, 5 vertical lines, 4 sync lines, 3 horizontal
+lines and the ROI, then zooms in and out. The window needs a display, so on a
+machine without one run it under Xvfb:
+
+xvfb-run python ecg_gui_bench.py --samples 1000000
+'''
+import sys
+import os
+import imp
+import json
+import time
+import argparse
+import tempfile
+import ecg_bench
+from ecg_engine import EXIT_SUCCESS, EXIT_FAILURE
+
+GUI_FILE_NAME = 'AnalyzeECG 2.2.1.py'
+CALI_DIALOG_TITLE = 'Please enter calibration factors'
+DEFAULT_SAMPLES = 100000
+DRAG_MOTIONS = 5  # motion events between the press and the release of a drag
+
+# script actions. Points are in data coordinates, so a script fits any window size
+ACTION_MODE = 'mode'  # pick a step in the drop-down menu
+ACTION_CLICK = 'click'
+ACTION_DRAG = 'drag'  # left button from the first point to the second one
+ACTION_DIALOG = 'dialog'  # press 'Save' in the calibration factor dialog
+ACTION_ZOOM = 'zoom'  # set the x-limits like the toolbar does
+
+
+def loadGUI():
+    guiFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), GUI_FILE_NAME)
+    app = imp.load_source('AnalyzeECG', guiFile)
+    app.createApp()
+    app.buildControls()
+    return app
+
+
+# the script an operator follows on a freshly loaded study
+def getDefaultScript(all_rows, ax):
+    annotation = ecg_bench.getAnnotation(all_rows)
+    yBottom, yTop = sorted(ax.get_ylim())
+    yMiddle = (yBottom + yTop) / 2.0
+    xMin = annotation['vLines'][0]
+    cali = annotation['calibration']
+    caliY = yBottom + (yTop - yBottom) * 0.05
+
+    script = [{'action': ACTION_MODE, 'step': 0},
+              {'action': ACTION_DRAG, 'points': [[xMin, caliY], [xMin + cali['deltaX'], caliY + cali['deltaY']]]},
+              {'action': ACTION_DIALOG},
+              {'action': ACTION_MODE, 'step': 1}]
+    script += [{'action': ACTION_CLICK, 'points': [[x, yMiddle]]} for x in annotation['vLines']]
+    script.append({'action': ACTION_MODE, 'step': 2})
+    script += [{'action': ACTION_CLICK, 'points': [[x, yMiddle]]} for x in annotation['syncLines']]
+    script.append({'action': ACTION_MODE, 'step': 3})
+    script += [{'action': ACTION_CLICK, 'points': [[xMin, y]]} for y in annotation['hLines']]
+    script.append({'action': ACTION_MODE, 'step': 4})
+    script.append({'action': ACTION_DRAG, 'points': [[annotation['roi'][0], yMiddle], [annotation['roi'][1], yMiddle]]})
+    script.append({'action': ACTION_ZOOM, 'points': [annotation['roi']]})
+    script.append({'action': ACTION_ZOOM, 'points': [[all_rows.allXmin, all_rows.allXmax]]})
+    return script
+
+
+#                 _
+#  _ __ ___ _ __ | | __ _ _   _
+# | '__/ _ \ '_ \| |/ _` | | | |
+# | | |  __/ |_) | | (_| | |_| |
+# |_|  \___| .__/|_|\__,_|\__, |
+#          |_|            |___/
+#
+# Sends one action to the GUI the way Tk would, then lets Tk run until the
+# scheduled redraw has been rendered and shown
+class Replayer(object):
+    def __init__(self, app):
+        self.app = app
+        self.canvas = app.canvas
+        self.ax = app.mainAx
+        # every full render, also the ones that do not go through the
+        # RedrawScheduler (RectangleSelector, toolbar)
+        self.draws = 0
+        self.canvas.mpl_connect('draw_event', self.onDraw)
+
+    def onDraw(self, event):
+        self.draws += 1
+
+    # Tk runs the idle callbacks (the scheduled redraw) and repaints the window
+    def waitForDraw(self):
+        self.app.root.update()
+        self.app.root.update_idletasks()
+
+    def toPixels(self, point):
+        x, y = self.ax.transData.transform((point[0], point[1]))
+        return x, y
+
+    def getDialogs(self):
+        return [w for w in self.app.root.winfo_children() if isinstance(w, self.app.Tk.Toplevel)]
+
+    # the warnings the GUI popped up, closed so they do not pile up
+    def closePopups(self):
+        popups = []
+        for dialog in self.getDialogs():
+            if dialog.title() == CALI_DIALOG_TITLE:
+                continue
+            texts = [w.cget('text') for w in dialog.winfo_children() if isinstance(w, self.app.Tk.Message)]
+            popups.append(dialog.title() + ': ' + ' '.join(texts))
+            dialog.destroy()
+        return popups
+
+    def send(self, action):
+        kind = action['action']
+        points = [self.toPixels(p) for p in action.get('points', [])]
+        if kind == ACTION_MODE:
+            self.app.selectedOp.set(self.app.userModes[action['step']])
+            self.app.selectOpCallBack(None)
+
+        elif kind == ACTION_CLICK:
+            x, y = points[0]
+            self.canvas.button_press_event(x, y, 1)
+            self.canvas.button_release_event(x, y, 1)
+
+        elif kind == ACTION_DRAG:
+            (x0, y0), (x1, y1) = points
+            self.canvas.button_press_event(x0, y0, 1)
+            for i in range(1, DRAG_MOTIONS + 1):
+                self.canvas.motion_notify_event(x0 + (x1 - x0) * i / DRAG_MOTIONS,
+                                                y0 + (y1 - y0) * i / DRAG_MOTIONS)
+            self.canvas.button_release_event(x1, y1, 1)
+
+        elif kind == ACTION_DIALOG:
+            for dialog in self.getDialogs():
+                if dialog.title() == CALI_DIALOG_TITLE:
+                    for w in dialog.winfo_children():
+                        if isinstance(w, self.app.Tk.Button):
+                            w.invoke()
+
+        elif kind == ACTION_ZOOM:
+            self.ax.set_xlim(action['points'][0])
+            self.canvas.draw_idle()
+
+        else:
+            raise ValueError('Unknown action: ' + str(kind))
+
+    # returns the timing of one action
+    def replay(self, index, action):
+        scheduler = self.app.redrawScheduler
+        drawsBefore = self.draws
+        blitsBefore = scheduler.blits
+        start = time.time()
+        self.send(action)
+        handled = time.time()
+        self.waitForDraw()
+        end = time.time()
+        return {
+            'index': index,
+            'action': action['action'],
+            'step': action.get('step'),
+            'callbackSeconds': handled - start,
+            'seconds': end - start,
+            'draws': self.draws - drawsBefore,
+            'blits': scheduler.blits - blitsBefore,
+            'popups': self.closePopups(),
+        }
+
+
+def getSummary(records):
+    summary = {}
+    for record in records:
+        summary.setdefault(record['action'], []).append(record['seconds'])
+    for kind, allSeconds in summary.items():
+        allSeconds.sort()
+        summary[kind] = {'count': len(allSeconds), 'mean': sum(allSeconds) / len(allSeconds),
+                         'median': allSeconds[len(allSeconds) // 2], 'max': allSeconds[-1]}
+    return summary
+
+
+def runScript(app, script):
+    replayer = Replayer(app)
+    records = []
+    for index, action in enumerate(script):
+        record = replayer.replay(index, action)
+        records.append(record)
+        print '{0:3} {1:<7} {2:9.2f}ms {3:9.2f}ms  draws {4} blits {5} {6}'.format(
+            index, record['action'], record['seconds'] * 1000, record['callbackSeconds'] * 1000,
+            record['draws'], record['blits'], ' '.join(record['popups']))
+        sys.stdout.flush()
+    return records
+
+
+# loads the study like the 'Set Data Folder' button, returns the seconds until it is shown
+def loadStudy(app, study_dir):
+    start = time.time()
+    if app.plotRawDataFromDir(study_dir) != EXIT_SUCCESS:
+        raise ValueError('Cannot load the study: ' + study_dir)
+    app.dataLoaded = True
+    app.root.update()
+    app.root.update_idletasks()
+    return time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the GUI on a replayed marking of a study')
+    parser.add_argument('study_dir', nargs='?', default=None, help='study to load (default: a synthetic one)')
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES,
+                        help='samples per row of the synthetic study')
+    parser.add_argument('--work', default=os.path.join(tempfile.gettempdir(), 'ecg_bench'),
+                        help='where the synthetic studies are kept')
+    parser.add_argument('--script', default=None, help='replay this JSON script instead of the default one')
+    parser.add_argument('--record', default=None, help='write the script that is replayed to this JSON file')
+    parser.add_argument('--out', default=None, help='also write the latencies to this JSON file')
+    args = parser.parse_args(argv)
+
+    studyDir = args.study_dir
+    if studyDir is None:
+        studyDir = ecg_bench.generateStudy(args.work, args.samples)
+
+    app = loadGUI()
+    try:
+        loadSeconds = loadStudy(app, studyDir)
+    except ValueError as e:
+        print >> sys.stderr, 'Error!', e
+        return EXIT_FAILURE
+
+    if args.script is not None:
+        with open(args.script) as fp:
+            script = json.load(fp)
+    else:
+        script = getDefaultScript(app.XYs, app.mainAx)
+    if args.record is not None:
+        with open(args.record, 'w') as fp:
+            json.dump(script, fp, indent=2)
+
+    print 'loaded {0} in {1:.2f}s'.format(studyDir, loadSeconds)
+    print '  # action    to draw   callback'
+    records = runScript(app, script)
+
+    summary = getSummary(records)
+    for kind in sorted(summary):
+        print '{0:<7} x{1:<3} mean {2:9.2f}ms median {3:9.2f}ms max {4:9.2f}ms'.format(
+            kind, summary[kind]['count'], summary[kind]['mean'] * 1000, summary[kind]['median'] * 1000,
+            summary[kind]['max'] * 1000)
+
+    if args.out is not None:
+        report = {'study': studyDir, 'environment': ecg_bench.getEnvironment(), 'loadSeconds': loadSeconds,
+                  'redraws': app.redrawScheduler.getStats(), 'summary': summary, 'actions': records}
+        with open(args.out, 'w') as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+        print 'Results:', args.out
+
+    app.root.destroy()
+    if any(record['popups'] for record in records):
+        # the script did not go through as recorded
+        return EXIT_FAILURE
+    return EXIT_SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(main())